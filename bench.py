@@ -0,0 +1,300 @@
+"""Offline crawl benchmark for parser.py.
+
+Serves recorded or synthetic registry pages from a local stand-in for freedns.afraid.org
+(with injected latency, 429/503 errors and dropped connections) and runs the real
+parser.main() against it in a fresh subprocess per scenario, so timings and peak RSS
+are not shared between runs.
+
+    python bench.py --pages 50,200 --workers 4,12 --latency-ms 80 --error-rate 0.03
+    python bench.py --pages-dir recorded/ --modes threads,async --json bench.json
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RESULT_MARKER = "BENCH_RESULT "
+
+
+def synthetic_page(page_num, total_pages, rows_per_page):
+    """One registry page in the markup parser.py expects, deterministic per page number."""
+    rows = []
+    for i in range(rows_per_page):
+        domain_id = page_num * rows_per_page + i
+        row_class = "trl" if i % 2 else "trd"
+        status = "public" if domain_id % 3 else "private"
+        rows.append(
+            f'<tr class="{row_class}"><td><a href="/subdomain/edit.php?edit_domain_id={domain_id}">'
+            f'dom{domain_id}.example{domain_id % 7}.com</a><br><span>({domain_id % 13} hosts in use) '
+            f'<a href="http://site{domain_id}.example.com" target="_blank">website</a></span></td>'
+            f'<td>{status}</td><td><a href="/user/?user_id={domain_id % 50}">owner{domain_id % 50}</a></td>'
+            f'<td>{domain_id % 400} days ago (0{1 + domain_id % 9}/1{domain_id % 10}/2020)</td></tr>'
+        )
+    return (
+        f'<html><head><title>FreeDNS - Domain Registry - Page {page_num} of {total_pages}</title></head><body>'
+        f'<table width="100%"><tr><td><form action="/domain/registry/"><font>Page '
+        f'<input name="page" value="{page_num}"> of {total_pages}</font></form></td></tr></table>'
+        f'<table><tr><td bgcolor="white"><center><table width="90%" border="0">'
+        f'<tr><td>Domain</td><td>Status</td><td>Owner</td><td>Age</td></tr>{"".join(rows)}'
+        f'</table></center></td></tr></table></body></html>'
+    )
+
+
+class RegistryStandIn:
+    """Local HTTP server answering /domain/registry/ and /domain/registry/page-N.html."""
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, drop_rate=0.0, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.reset_counters()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stand_in.handle(self)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/domain/registry/"
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counters(self):
+        self.counters = {'requests': 0, 'errors_429': 0, 'errors_503': 0, 'dropped': 0, 'bytes_sent': 0}
+
+    def load_synthetic(self, total_pages, rows_per_page):
+        self.pages = {n: synthetic_page(n, total_pages, rows_per_page).encode('utf-8') for n in range(1, total_pages + 1)}
+
+    def load_recorded(self, pages_dir):
+        """Loads page-N.html files; page-1.html (or index.html) is served as the registry's first page."""
+        pages = {}
+        for name in os.listdir(pages_dir):
+            match = re.fullmatch(r'page-(\d+)\.html', name)
+            page_num = int(match.group(1)) if match else (1 if name == 'index.html' else None)
+            if page_num is not None:
+                with open(os.path.join(pages_dir, name), 'rb') as f:
+                    pages[page_num] = f.read()
+        if 1 not in pages:
+            raise SystemExit(f"{pages_dir} has no page-1.html or index.html")
+        self.pages = pages
+
+    def handle(self, request):
+        match = re.search(r'page-(\d+)\.html', request.path)
+        page_num = int(match.group(1)) if match else 1
+        with self.lock:
+            self.counters['requests'] += 1
+            roll = self.random.random()
+            delay = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+        time.sleep(delay)
+
+        if roll < self.drop_rate:
+            with self.lock:
+                self.counters['dropped'] += 1
+            request.close_connection = True
+            request.connection.close()
+            return
+        if roll < self.drop_rate + self.error_rate:
+            status = 429 if roll < self.drop_rate + self.error_rate / 2 else 503
+            with self.lock:
+                self.counters[f'errors_{status}'] += 1
+            request.send_response(status)
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+
+        body = self.pages.get(page_num)
+        if body is None:
+            request.send_response(404)
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+        encoding = None
+        if 'gzip' in (request.headers.get('Accept-Encoding') or ''):
+            body = gzip.compress(body, compresslevel=6)
+            encoding = 'gzip'
+        request.send_response(200)
+        request.send_header('Content-Type', 'text/html; charset=utf-8')
+        request.send_header('Content-Length', str(len(body)))
+        if encoding:
+            request.send_header('Content-Encoding', encoding)
+        request.end_headers()
+        request.wfile.write(body)
+        with self.lock:
+            self.counters['bytes_sent'] += len(body)
+
+
+def run_child(config):
+    """Runs parser.main() once against the stand-in and prints one BENCH_RESULT line."""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import parser as fraidex_parser
+
+    out_dir = config['out_dir']
+    fraidex_parser.BASE_URL = config['base_url']
+    fraidex_parser.OUTPUT_JSON_FILE = os.path.join(out_dir, 'fraidex.json')
+    fraidex_parser.PREVIOUS_JSON_FILE = os.path.join(out_dir, 'fraidex_previous.json')
+    fraidex_parser.COLUMNAR_JSON_FILE = os.path.join(out_dir, 'fraidex.columns.json')
+    fraidex_parser.SEARCH_INDEX_DIR = os.path.join(out_dir, 'fraidex_index')
+    fraidex_parser.PATCH_JSON_FILE = os.path.join(out_dir, 'fraidex.patch.json')
+    if config.get('initial_backoff') is not None:
+        fraidex_parser.INITIAL_BACKOFF_SECONDS = config['initial_backoff']
+        fraidex_parser.JITTER_SECONDS = min(fraidex_parser.JITTER_SECONDS, config['initial_backoff'] / 2)
+
+    started = time.perf_counter()
+    fraidex_parser.main()
+    wall_time = time.perf_counter() - started
+
+    rows = 0
+    if os.path.exists(fraidex_parser.OUTPUT_JSON_FILE):
+        with open(fraidex_parser.OUTPUT_JSON_FILE, 'r', encoding='utf-8') as f:
+            rows = len(json.load(f))
+
+    # Parse cost per page as the crawl itself measured it, wherever the parse ran (inline or in the
+    # process pool); pages served from the page cache were not parsed and are not counted
+    parse_ms = None
+    pages_parsed = 0
+    if os.path.exists(fraidex_parser.METRICS_JSON_FILE):
+        with open(fraidex_parser.METRICS_JSON_FILE, 'r', encoding='utf-8') as f:
+            parse_stats = json.load(f)['parse_seconds']
+        if parse_stats:
+            parse_ms = parse_stats['mean'] * 1000
+            pages_parsed = parse_stats['count']
+
+    print(RESULT_MARKER + json.dumps({
+        'wall_time': wall_time,
+        'rows': rows,
+        'parse_ms_per_page': parse_ms,
+        'pages_parsed': pages_parsed,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_child_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }))
+
+
+def run_scenario(stand_in, mode, workers, args, extra_env):
+    stand_in.reset_counters()
+    # Stateful stores only when asked for with --env, never the caller's real ones
+    env = {key: value for key, value in os.environ.items() if key not in ('FRAIDEX_HISTORY_DB', 'FRAIDEX_PAGE_CACHE_FILE', 'FRAIDEX_JOURNAL_FILE')}
+    env.update(extra_env)
+    env['FRAIDEX_CRAWL_MODE'] = mode
+    env['FRAIDEX_MAX_WORKERS'] = str(workers)
+    env['FRAIDEX_ASYNC_MAX_CONCURRENCY'] = str(workers)
+    env['FRAIDEX_ASYNC_INITIAL_CONCURRENCY'] = str(min(workers, int(env.get('FRAIDEX_ASYNC_INITIAL_CONCURRENCY', '8'))))
+    with tempfile.TemporaryDirectory(prefix='fraidex-bench-') as out_dir:
+        config = {'base_url': stand_in.base_url, 'out_dir': out_dir, 'initial_backoff': args.initial_backoff}
+        # The crawl's own metrics summary is where run_child reads parse times from
+        env['FRAIDEX_METRICS_JSON'] = os.path.join(out_dir, 'crawl_metrics.json')
+        env['FRAIDEX_METRICS_PROM'] = ''
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '_child', json.dumps(config)],
+            env=env, capture_output=True, text=True)
+    result_lines = [line for line in completed.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+    if completed.returncode != 0 or not result_lines:
+        print(completed.stdout[-2000:])
+        print(completed.stderr[-2000:], file=sys.stderr)
+        raise SystemExit(f"Benchmark child failed for mode={mode} workers={workers}")
+    if args.verbose:
+        print(completed.stdout)
+    result = json.loads(result_lines[-1][len(RESULT_MARKER):])
+    pages = len(stand_in.pages)
+    # Every request beyond one per page was a retry
+    result.update({
+        'mode': mode,
+        'workers': workers,
+        'pages': pages,
+        'pages_per_sec': pages / result['wall_time'] if result['wall_time'] else None,
+        'retries': max(0, stand_in.counters['requests'] - pages),
+        **stand_in.counters,
+    })
+    return result
+
+
+def print_table(results):
+    header = f"{'mode':<8}{'workers':>8}{'pages':>7}{'rows':>8}{'wall s':>9}{'pages/s':>9}{'parse ms':>10}{'retries':>9}{'429':>6}{'503':>6}{'drop':>6}{'RSS MB':>8}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        parse_ms = f"{r['parse_ms_per_page']:.2f}" if r['parse_ms_per_page'] is not None else '-'
+        print(f"{r['mode']:<8}{r['workers']:>8}{r['pages']:>7}{r['rows']:>8}{r['wall_time']:>9.2f}"
+              f"{r['pages_per_sec']:>9.1f}{parse_ms:>10}{r['retries']:>9}{r['errors_429']:>6}"
+              f"{r['errors_503']:>6}{r['dropped']:>6}{r['peak_rss_kb'] / 1024:>8.1f}")
+
+
+def parse_int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--pages', type=parse_int_list, default=[50], help="Synthetic registry sizes in pages (comma-separated)")
+    arg_parser.add_argument('--rows-per-page', type=int, default=100)
+    arg_parser.add_argument('--pages-dir', help="Serve recorded page-N.html files instead of synthetic pages")
+    arg_parser.add_argument('--workers', type=parse_int_list, default=[12], help="Worker counts / async concurrency ceilings to compare")
+    arg_parser.add_argument('--modes', default='threads', help="Crawl modes to compare: threads,async")
+    arg_parser.add_argument('--latency-ms', type=float, default=50.0)
+    arg_parser.add_argument('--jitter-ms', type=float, default=10.0)
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests answered with 429/503")
+    arg_parser.add_argument('--drop-rate', type=float, default=0.0, help="Share of connections closed without a response")
+    arg_parser.add_argument('--initial-backoff', type=float, default=None, help="Override INITIAL_BACKOFF_SECONDS to keep error scenarios short")
+    arg_parser.add_argument('--env', action='append', default=[], help="Extra FRAIDEX_* setting for the parser, e.g. --env FRAIDEX_PARSE_ENGINE=lxml")
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--json', help="Also write the results to this JSON file")
+    arg_parser.add_argument('--verbose', action='store_true', help="Show the parser's own output")
+    args = arg_parser.parse_args(argv)
+
+    extra_env = dict(item.split('=', 1) for item in args.env)
+    stand_in = RegistryStandIn(args.latency_ms, args.jitter_ms, args.error_rate, args.drop_rate, args.seed)
+    stand_in.start()
+    results = []
+    try:
+        sizes = [None] if args.pages_dir else args.pages
+        for size in sizes:
+            if args.pages_dir:
+                stand_in.load_recorded(args.pages_dir)
+            else:
+                stand_in.load_synthetic(size, args.rows_per_page)
+            for mode in [m.strip() for m in args.modes.split(',') if m.strip()]:
+                for workers in args.workers:
+                    print(f"Running mode={mode} workers={workers} pages={len(stand_in.pages)}...")
+                    results.append(run_scenario(stand_in, mode, workers, args, extra_env))
+    finally:
+        stand_in.stop()
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote results to {args.json}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == '_child':
+        run_child(json.loads(sys.argv[2]))
+    else:
+        main()
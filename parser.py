@@ -1,17 +1,63 @@
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 import json
+import hashlib
+import math
+import heapq
+import sqlite3
+import gzip
+import glob
 import re
 from datetime import datetime, timedelta
 import time
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import sys
+import shutil
+import argparse
+import contextlib
+import asyncio
+import queue
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 import random # For jitter and random user agent selection
 
+try:
+    import aiohttp # Only needed for the async crawl mode
+except ImportError:
+    aiohttp = None
+try:
+    import brotli # Only needed for the .br variant of the columnar output
+except ImportError:
+    brotli = None
+try:
+    from lxml import etree, html as lxml_html # Needed for the lxml parse engine
+except ImportError:
+    etree = lxml_html = None
+
 BASE_URL = "https://freedns.afraid.org/domain/registry/"
 OUTPUT_JSON_FILE = os.path.join(os.path.dirname(__file__), "fraidex.json")
 # Previous run's data, fetched by the workflow before the parser runs
 PREVIOUS_JSON_FILE = os.path.join(os.path.dirname(__file__), "fraidex_previous.json")
+# Columnar, dictionary-encoded variant of the same data (plus .gz/.br siblings) for the frontend
+COLUMNAR_JSON_FILE = os.path.join(os.path.dirname(__file__), "fraidex.columns.json")
+COLUMNAR_FORMAT_VERSION = 1
+# Prebuilt search artifacts: per-TLD and per-status shards plus a trigram index over domain_name
+SEARCH_INDEX_DIR = os.path.join(os.path.dirname(__file__), "fraidex_index")
+SEARCH_INDEX_VERSION = 1
+# Keyed diff (by domain_id) between the previous run and this one, for hourly pollers
+PATCH_JSON_FILE = os.path.join(os.path.dirname(__file__), "fraidex.patch.json")
+PATCH_FORMAT_VERSION = 1
+# Fields that drift on their own (clock- or position-derived) and are left out of "changed";
+# patch consumers recompute them from date_added / first_seen.
+PATCH_IGNORED_FIELDS = ('age_raw_text', 'age_days', 'fraidex_age_days', 'source_page_number')
+
+# --- History store ---
+# When set, first_seen/last_seen and a hosts_in_use/status time series live in this SQLite file
+# instead of being carried through fraidex_previous.json; fraidex.json is written from it.
+HISTORY_DB_FILE = os.environ.get("FRAIDEX_HISTORY_DB", "")
+HISTORY_BATCH_SIZE = 500 # Rows per executemany/IN (...) batch; stays under SQLite's variable limit
 
 # --- List of User Agents ---
 USER_AGENTS = [
@@ -97,6 +143,7 @@ USER_AGENTS = [
 BASE_HEADERS = {
     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
     'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': 'gzip, deflate',
     'Referer': 'https://freedns.afraid.org/subdomain/save.php?step=2',
     'Connection': 'keep-alive',
     'Upgrade-Insecure-Requests': '1',
@@ -108,7 +155,7 @@ BASE_HEADERS = {
 }
 
 # --- Configuration for Concurrency and Retries ---
-MAX_WORKERS = 12
+MAX_WORKERS = int(os.environ.get("FRAIDEX_MAX_WORKERS", "12"))
 REQUEST_TIMEOUT = 30
 
 MAX_FETCH_RETRIES = 19
@@ -116,59 +163,423 @@ INITIAL_BACKOFF_SECONDS = 1
 BACKOFF_FACTOR = 2
 JITTER_SECONDS = 0.5
 
+# --- Retry scheduler (pages 2..N) ---
+# Failed pages go on a deferred queue instead of sleeping in a worker. Retries are capped per page
+# (MAX_FETCH_RETRIES), per run (the retry budget) and by the run deadline, and a circuit breaker
+# pauses all fetching while the recent error rate is too high.
+RETRY_MAX_BACKOFF_SECONDS = 300
+RETRY_BUDGET = int(os.environ.get("FRAIDEX_RETRY_BUDGET", "0")) # 0 = max(RETRY_BUDGET_MIN, RETRY_BUDGET_RATIO * pages)
+RETRY_BUDGET_MIN = 50
+RETRY_BUDGET_RATIO = 0.25
+CRAWL_DEADLINE_SECONDS = int(os.environ.get("FRAIDEX_CRAWL_DEADLINE_SECONDS", str(45 * 60))) # Leaves room inside the hourly slot
+BREAKER_WINDOW = 20 # Most recent attempts considered by the circuit breaker
+BREAKER_MIN_ATTEMPTS = 10
+BREAKER_ERROR_RATE = 0.5
+BREAKER_COOLDOWN_SECONDS = 30
+BREAKER_MAX_COOLDOWN_SECONDS = 300
+
+# --- Async crawl mode (FRAIDEX_CRAWL_MODE=async, requires aiohttp) ---
+# Concurrency starts at ASYNC_INITIAL_CONCURRENCY and adapts between the min/max bounds:
+# it grows while latency stays close to the best latency seen, and halves on timeouts, 429s and 5xx.
+CRAWL_MODE = os.environ.get("FRAIDEX_CRAWL_MODE", "threads")
+ASYNC_INITIAL_CONCURRENCY = int(os.environ.get("FRAIDEX_ASYNC_INITIAL_CONCURRENCY", "8"))
+ASYNC_MIN_CONCURRENCY = int(os.environ.get("FRAIDEX_ASYNC_MIN_CONCURRENCY", "2"))
+ASYNC_MAX_CONCURRENCY = int(os.environ.get("FRAIDEX_ASYNC_MAX_CONCURRENCY", "48"))
+ASYNC_LATENCY_TOLERANCE = 2.0 # Growth stops once smoothed latency exceeds this multiple of the best latency
+
+# --- Speculative start ---
+# When enabled, pages 2..N of the previous run's page count are fetched alongside page 1 instead of
+# after it; the range is trimmed or extended once page 1 gives the real count.
+SPECULATIVE_FETCH = os.environ.get("FRAIDEX_SPECULATIVE_FETCH", "0") == "1"
+
+# --- Parse stage ---
+# With PARSE_WORKERS > 0 the fetch stage hands raw HTML to a process pool instead of parsing it
+# on the consumer thread; parsed rows are merged back in page order either way.
+PARSE_WORKERS = int(os.environ.get("FRAIDEX_PARSE_WORKERS", "0"))
+# "bs4" (BeautifulSoup tree), "lxml" (compiled XPath on lxml.html, no soup) or
+# "parity" (run both, report differing fields, keep the bs4 rows)
+PARSE_ENGINE = os.environ.get("FRAIDEX_PARSE_ENGINE", "bs4")
+
+# --- Page cache ---
+# When set, pages are fetched with If-None-Match/If-Modified-Since and pages that come back
+# 304 or byte-identical reuse their cached rows instead of being parsed again.
+PAGE_CACHE_FILE = os.environ.get("FRAIDEX_PAGE_CACHE_FILE", "")
+PAGE_CACHE_VERSION = 1
+
+# --- Crawl journal ---
+# When set, each finished page's rows are appended (and fsynced) to this NDJSON file during the crawl.
+# A rerun after a crash or a partial failure fetches page 1 plus only the pages missing from the
+# journal; the file is removed once a run has every page.
+JOURNAL_FILE = os.environ.get("FRAIDEX_JOURNAL_FILE", "")
+JOURNAL_VERSION = 1
+JOURNAL_MAX_AGE_SECONDS = int(os.environ.get("FRAIDEX_JOURNAL_MAX_AGE_SECONDS", "1800")) # Since its last write; older journals are discarded
+# With FRAIDEX_PUBLISH_INCOMPLETE=0 and a journal, a run that is missing pages publishes nothing and
+# records no history run, leaving the publishing to the rerun that resumes from the journal
+PUBLISH_INCOMPLETE = os.environ.get("FRAIDEX_PUBLISH_INCOMPLETE", "1") == "1"
+
+# --- Crawl metrics ---
+# Per-page fetch/parse measurements summarised at the end of the run; empty paths skip writing.
+METRICS_JSON_FILE = os.environ.get("FRAIDEX_METRICS_JSON", "")
+METRICS_PROMETHEUS_FILE = os.environ.get("FRAIDEX_METRICS_PROM", "")
+METRICS_SLOWEST_PAGES = 10
+
+# Rows written between flushes by the stream command (one registry page)
+STREAM_FLUSH_ROWS = 100
+
+# --- Sharded crawl ---
+# "shard" commands each crawl one slice of the page range into a partial NDJSON file; "merge" then
+# builds fraidex.json (and the other outputs) from them.
+SHARD_FILE_TEMPLATE = os.path.join(os.path.dirname(__file__), "fraidex.shard-{index}-of-{count}.ndjson")
+SHARD_FORMAT_VERSION = 1
+# Shards of one crawl share a run id (e.g. the CI run id). merge only combines shards of the newest
+# run; without run ids, shards that started this long before the newest one are taken as stale.
+SHARD_RUN_ID = os.environ.get("FRAIDEX_RUN_ID", "")
+SHARD_MAX_START_SKEW_SECONDS = 30 * 60
+SHARD_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Returned by the fetchers in place of the HTML when the server answers 304 Not Modified
+NOT_MODIFIED = object()
+
+class CrawlError(Exception):
+    """The crawl could not start: page 1, and with it the page count, could not be fetched."""
+
 def get_random_user_agent_headers():
     """Returns a new headers dictionary with a randomly chosen User-Agent."""
     headers = BASE_HEADERS.copy() # Start with a copy of base headers
     headers['User-Agent'] = random.choice(USER_AGENTS)
     return headers
 
-def fetch_page_content(page_num, session):
-    """Fetches HTML content for a given page number with retries, backoff, and random User-Agent."""
+def create_session():
+    """Returns a requests.Session whose keep-alive pool is large enough for MAX_WORKERS threads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def get_page_url(page_num):
     if page_num == 1:
-        url = BASE_URL
-    else:
-        url = f"{BASE_URL}page-{page_num}.html"
-    
-    current_retries = 0
-    current_backoff = INITIAL_BACKOFF_SECONDS
+        return BASE_URL
+    return f"{BASE_URL}page-{page_num}.html"
 
-    while current_retries <= MAX_FETCH_RETRIES:
-        request_headers = get_random_user_agent_headers() # Get fresh headers for each attempt
-        try:
-            response = session.get(url, headers=request_headers, timeout=REQUEST_TIMEOUT)
+def fetch_page_attempt(page_num, session, page_cache=None, metrics=None):
+    """Makes one request for a page. Returns (html_content or NOT_MODIFIED, None) or (None, error message)."""
+    url = get_page_url(page_num)
+    request_headers = get_random_user_agent_headers() # Get fresh headers for each attempt
+    if page_cache is not None:
+        request_headers.update(page_cache.conditional_headers(page_num))
+    attempt_started = time.perf_counter()
+    try:
+        response = session.get(url, headers=request_headers, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        if metrics is not None:
+            metrics.record_attempt(page_num, str(response.status_code), time.perf_counter() - attempt_started, len(response.content), ok=True)
+        if page_cache is not None:
+            page_cache.record_validators(page_num, response.headers)
+        if response.status_code == 304:
+            return NOT_MODIFIED, None
+        return response.text, None
+    except requests.exceptions.Timeout:
+        error_msg = f"Timeout"
+        status_label = "timeout"
+    except requests.exceptions.ConnectionError:
+        error_msg = f"Connection error"
+        status_label = "connection_error"
+    except requests.exceptions.RequestException as e:
+        error_msg = f"RequestException: {type(e).__name__}"
+        status_label = type(e).__name__
+        if hasattr(e, 'response') and e.response is not None:
+             error_msg += f" (Status: {e.response.status_code})"
+             status_label = str(e.response.status_code)
+    if metrics is not None:
+        metrics.record_attempt(page_num, status_label, time.perf_counter() - attempt_started, 0, ok=False)
+    return None, f"{error_msg} fetching page {page_num} ({url}) with UA '{request_headers.get('User-Agent', 'N/A')}'"
+
+class RetryScheduler:
+    """Hands out pages to fetch and owns every retry decision for them, for threads and coroutines alike.
+
+    A failed page goes on a deferred heap with its exponential backoff (capped at
+    RETRY_MAX_BACKOFF_SECONDS) instead of holding a worker. A page is given up once it has used
+    MAX_FETCH_RETRIES retries, once the run-wide retry budget is spent, or when its next attempt
+    would land past the deadline. The circuit breaker opens when at least BREAKER_ERROR_RATE of the
+    last BREAKER_WINDOW attempts failed, pausing all fetching for a cooldown; then a single probe
+    either closes it or reopens it with a doubled cooldown.
+
+    A provisional scheduler (page 1, plus speculative pages fetched before page 1 gives the real
+    page count) never reports finished until replan() hands it the real page list. While it is
+    provisional, due retries jump the queue so a failing page 1 is not stuck behind speculative pages.
+    """
+
+    def __init__(self, page_nums, retry_budget, deadline_seconds, provisional=False):
+        self.lock = threading.Lock()
+        self.ready = deque(page_nums)
+        self.wanted = set(page_nums)
+        self.provisional = provisional
+        self.deferred = [] # heap of (due monotonic time, page_num)
+        self.in_flight = set()
+        self.failures = {}
+        self.given_up = []
+        self.succeeded = set()
+        self.retry_budget = retry_budget
+        self.retries_used = 0
+        self.deadline = time.monotonic() + deadline_seconds
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)
+        self.breaker_state = 'closed'
+        self.breaker_open_until = 0.0
+        self.breaker_cooldown = BREAKER_COOLDOWN_SECONDS
+        self.budget_reported = False
+
+    def next_page(self):
+        """The next page to attempt now, or None if nothing is due, the breaker is open or the deadline passed."""
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.deadline:
+                self._abandon_pending()
+                return None
+            if self.breaker_state == 'open':
+                if now < self.breaker_open_until:
+                    return None
+                self.breaker_state = 'half_open'
+                print("Circuit breaker half-open: sending one probe request.")
+            if self.breaker_state == 'half_open' and self.in_flight:
+                return None
+            while self.deferred and self.deferred[0][0] <= now:
+                if self.provisional:
+                    self.ready.appendleft(heapq.heappop(self.deferred)[1])
+                else:
+                    self.ready.append(heapq.heappop(self.deferred)[1])
+            if not self.ready:
+                return None
+            page_num = self.ready.popleft()
+            self.in_flight.add(page_num)
+            return page_num
+
+    def wait_seconds(self):
+        """How long a worker with nothing to do should wait before asking again."""
+        with self.lock:
+            now = time.monotonic()
+            candidates = [1.0, self.deadline - now]
+            if self.provisional:
+                candidates.append(0.0) # Poll briefly: page 1 may queue more pages at any moment
+            if self.breaker_state == 'open':
+                candidates.append(self.breaker_open_until - now)
+            elif self.deferred:
+                candidates.append(self.deferred[0][0] - now)
+            return max(0.05, min(candidates))
+
+    def finished(self):
+        with self.lock:
+            return not self.provisional and not self.ready and not self.deferred and not self.in_flight
+
+    def wants(self, page_num):
+        with self.lock:
+            return page_num in self.wanted
+
+    def gave_up_on(self, page_num):
+        with self.lock:
+            return page_num in self.given_up
+
+    def resolved_count(self):
+        """Wanted pages fetched or given up so far."""
+        with self.lock:
+            return len(self.succeeded) + len(self.given_up)
+
+    def replan(self, page_nums, retry_budget):
+        """Replaces the provisional page list with the real one. Pages no longer wanted are dropped
+        (attempts still in flight for them are ignored), new ones are queued, finished ones stay finished."""
+        with self.lock:
+            wanted = set(page_nums)
+            self.ready = deque([page_num for page_num in self.ready if page_num in wanted] +
+                               [page_num for page_num in page_nums if page_num not in self.wanted])
+            self.deferred = [(due, page_num) for due, page_num in self.deferred if page_num in wanted]
+            heapq.heapify(self.deferred)
+            self.succeeded &= wanted
+            self.given_up = [page_num for page_num in self.given_up if page_num in wanted]
+            self.wanted = wanted
+            self.retry_budget = max(retry_budget, self.retries_used)
+            self.provisional = False
+
+    def record_success(self, page_num):
+        with self.lock:
+            self.in_flight.discard(page_num)
+            if page_num in self.wanted:
+                self.succeeded.add(page_num)
+            self.outcomes.append(True)
+            if self.breaker_state == 'half_open':
+                print("Circuit breaker closed: probe succeeded, resuming fetching.")
+                self.breaker_state = 'closed'
+                self.breaker_cooldown = BREAKER_COOLDOWN_SECONDS
+                self.outcomes.clear()
+
+    def record_failure(self, page_num):
+        """Defers the page for a retry and returns the delay, or returns None if the page is given up."""
+        with self.lock:
+            now = time.monotonic()
+            self.in_flight.discard(page_num)
+            self.outcomes.append(False)
+            self._update_breaker(now)
+            if page_num not in self.wanted:
+                return None
+            failures = self.failures[page_num] = self.failures.get(page_num, 0) + 1
+            if failures > MAX_FETCH_RETRIES:
+                reason = f"after {failures} attempts"
+            elif self.retries_used >= self.retry_budget:
+                reason = f"the run's retry budget of {self.retry_budget} is spent"
+                if not self.budget_reported:
+                    print(f"Retry budget of {self.retry_budget} retries exhausted; further failures are final.")
+                    self.budget_reported = True
+            else:
+                delay = min(RETRY_MAX_BACKOFF_SECONDS, INITIAL_BACKOFF_SECONDS * BACKOFF_FACTOR ** (failures - 1))
+                delay = max(0.1, delay + random.uniform(-JITTER_SECONDS, JITTER_SECONDS))
+                due = max(now + delay, self.breaker_open_until)
+                if due < self.deadline:
+                    self.retries_used += 1
+                    heapq.heappush(self.deferred, (due, page_num))
+                    return due - now
+                reason = "its next attempt would be past the run deadline"
+            print(f"Giving up on page {page_num}: {reason}.")
+            self.given_up.append(page_num)
+            return None
+
+    def _update_breaker(self, now):
+        if self.breaker_state == 'half_open':
+            self.breaker_cooldown = min(BREAKER_MAX_COOLDOWN_SECONDS, self.breaker_cooldown * 2)
+            self._open_breaker(now, "probe failed")
+        elif self.breaker_state == 'closed' and len(self.outcomes) >= BREAKER_MIN_ATTEMPTS:
+            error_rate = self.outcomes.count(False) / len(self.outcomes)
+            if error_rate >= BREAKER_ERROR_RATE:
+                self._open_breaker(now, f"{error_rate:.0%} of the last {len(self.outcomes)} attempts failed")
+
+    def _open_breaker(self, now, reason):
+        self.breaker_state = 'open'
+        self.breaker_open_until = now + self.breaker_cooldown
+        self.outcomes.clear()
+        print(f"Circuit breaker open ({reason}): pausing all fetching for {self.breaker_cooldown:.1f}s.")
+
+    def _abandon_pending(self):
+        pending = list(self.ready) + [page_num for _, page_num in self.deferred]
+        if pending:
+            print(f"Run deadline reached: giving up on {len(pending)} pages that were not fetched yet.")
+            self.given_up.extend(pending)
+            self.ready.clear()
+            self.deferred.clear()
+
+def retry_budget_for(page_nums):
+    return RETRY_BUDGET or max(RETRY_BUDGET_MIN, int(len(page_nums) * RETRY_BUDGET_RATIO))
+
+def create_retry_scheduler(page_nums, provisional=False):
+    return RetryScheduler(page_nums, retry_budget_for(page_nums), CRAWL_DEADLINE_SECONDS, provisional)
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limit on in-flight requests for the async crawl.
+
+    The limit grows by one after a full window of responses whose smoothed latency stays within
+    ASYNC_LATENCY_TOLERANCE of the best latency seen, and halves (at most once per latency period)
+    when a request times out or gets a 429/5xx.
+    """
+
+    def __init__(self, initial, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = max(self.minimum, min(initial, self.maximum))
+        self.in_flight = 0
+        self.best_latency = None
+        self.smoothed_latency = None
+        self.window_successes = 0
+        self.last_backoff = 0.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, latency, congested=False):
+        async with self.condition:
+            self.in_flight -= 1
+            if congested:
+                now = time.monotonic()
+                if now - self.last_backoff >= (self.smoothed_latency or 1.0):
+                    new_limit = max(self.minimum, self.limit // 2)
+                    if new_limit != self.limit:
+                        print(f"Upstream congestion detected, reducing concurrency {self.limit} -> {new_limit}.")
+                    self.limit = new_limit
+                    self.last_backoff = now
+                self.window_successes = 0
+            elif latency is not None:
+                self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+                self.smoothed_latency = latency if self.smoothed_latency is None else 0.8 * self.smoothed_latency + 0.2 * latency
+                if self.smoothed_latency <= self.best_latency * ASYNC_LATENCY_TOLERANCE:
+                    self.window_successes += 1
+                    if self.window_successes >= self.limit and self.limit < self.maximum:
+                        self.limit += 1
+                        self.window_successes = 0
+                else:
+                    self.window_successes = 0
+            self.condition.notify_all()
+
+async def fetch_page_attempt_async(page_num, session, limiter, page_cache=None, metrics=None):
+    """Async counterpart of fetch_page_attempt. The caller must hold a limiter slot; it is released
+    here with the attempt's latency and congestion signal."""
+    url = get_page_url(page_num)
+    request_headers = get_random_user_agent_headers() # Get fresh headers for each attempt
+    if page_cache is not None:
+        request_headers.update(page_cache.conditional_headers(page_num))
+    html_content = None
+    response_bytes = 0
+    congested = False
+    started = time.monotonic()
+    try:
+        async with session.get(url, headers=request_headers, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)) as response:
+            status_label = str(response.status)
+            if response.status == 429 or response.status >= 500:
+                congested = True
             response.raise_for_status()
-            return page_num, response.text
-        except requests.exceptions.Timeout:
-            error_msg = f"Timeout"
-        except requests.exceptions.ConnectionError:
-            error_msg = f"Connection error"
-        except requests.exceptions.RequestException as e:
-            error_msg = f"RequestException: {type(e).__name__}"
-            if hasattr(e, 'response') and e.response is not None:
-                 error_msg += f" (Status: {e.response.status_code})"
-
-        print(f"{error_msg} fetching page {page_num} ({url}) with UA '{request_headers.get('User-Agent', 'N/A')}' on attempt {current_retries + 1}/{MAX_FETCH_RETRIES + 1}.")
-
-        if current_retries < MAX_FETCH_RETRIES:
-            sleep_duration = current_backoff + random.uniform(-JITTER_SECONDS, JITTER_SECONDS)
-            sleep_duration = max(0.1, sleep_duration)
-            
-            print(f"Page {page_num}: Waiting {sleep_duration:.2f}s before next retry...")
-            time.sleep(sleep_duration)
-            current_backoff *= BACKOFF_FACTOR
-        current_retries += 1
-    
-    print(f"Failed to fetch page {page_num} ({url}) after {MAX_FETCH_RETRIES + 1} attempts.")
-    return page_num, None
+            if page_cache is not None:
+                page_cache.record_validators(page_num, response.headers)
+            if response.status == 304:
+                html_content = NOT_MODIFIED
+            else:
+                body = await response.read()
+                response_bytes = len(body)
+                html_content = body.decode(response.get_encoding(), errors='replace')
+    except asyncio.TimeoutError:
+        error_msg = f"Timeout"
+        status_label = "timeout"
+        congested = True
+    except aiohttp.ClientResponseError as e:
+        error_msg = f"RequestException: {type(e).__name__} (Status: {e.status})"
+        status_label = str(e.status)
+    except aiohttp.ClientConnectionError:
+        error_msg = f"Connection error"
+        status_label = "connection_error"
+    except aiohttp.ClientError as e:
+        error_msg = f"RequestException: {type(e).__name__}"
+        status_label = type(e).__name__
+    finally:
+        # Also on unexpected errors and cancellation, or the slot would be lost for the rest of the run
+        elapsed = time.monotonic() - started
+        await limiter.release(elapsed if html_content is not None else None, congested)
+    if metrics is not None:
+        metrics.record_attempt(page_num, status_label, elapsed, response_bytes, ok=html_content is not None)
+    if html_content is not None:
+        return html_content, None
+    return None, f"{error_msg} fetching page {page_num} ({url}) with UA '{request_headers.get('User-Agent', 'N/A')}'"
+
+DATE_IN_PARENS_RE = re.compile(r'\((\d{2}/\d{2}/\d{4})\)')
+DAYS_AGO_RE = re.compile(r'(\d+)\s+days\s+ago')
+HOSTS_IN_USE_RE = re.compile(r'\((\d+)\s+hosts\s+in\s+use\)')
+DOMAIN_ID_RE = re.compile(r'edit_domain_id=(\d+)')
+USER_ID_RE = re.compile(r'user_id=(\d+)')
 
 def parse_date_from_age(age_str):
-    date_match = re.search(r'\((\d{2}/\d{2}/\d{4})\)', age_str)
+    date_match = DATE_IN_PARENS_RE.search(age_str)
     if date_match:
         try:
             dt_obj = datetime.strptime(date_match.group(1), '%m/%d/%Y')
             return dt_obj.strftime('%Y-%m-%d')
         except ValueError: pass
-    days_ago_match = re.search(r'(\d+)\s+days\s+ago', age_str)
+    days_ago_match = DAYS_AGO_RE.search(age_str)
     if days_ago_match:
         try:
             days = int(days_ago_match.group(1))
@@ -185,7 +596,7 @@ def parse_domain_row(row_element):
     domain_anchor = domain_cell.find('a')
     if domain_anchor and domain_anchor.has_attr('href'):
         domain_data['domain_name'] = domain_anchor.get_text(strip=True)
-        domain_id_match = re.search(r'edit_domain_id=(\d+)', domain_anchor['href'])
+        domain_id_match = DOMAIN_ID_RE.search(domain_anchor['href'])
         domain_data['domain_id'] = int(domain_id_match.group(1)) if domain_id_match else None
     else: 
         domain_data['domain_name'] = domain_cell.get_text(strip=True).split('\n')[0] if domain_cell.get_text(strip=True) else None
@@ -194,7 +605,7 @@ def parse_domain_row(row_element):
     span_tag = domain_cell.find('span')
     if span_tag:
         span_text = span_tag.get_text(strip=True)
-        hosts_match = re.search(r'\((\d+)\s+hosts\s+in\s+use\)', span_text)
+        hosts_match = HOSTS_IN_USE_RE.search(span_text)
         domain_data['hosts_in_use'] = int(hosts_match.group(1)) if hosts_match else 0
         website_anchor = span_tag.find('a', {'target': '_blank'})
         domain_data['website'] = website_anchor['href'] if website_anchor and website_anchor.has_attr('href') else None
@@ -206,7 +617,7 @@ def parse_domain_row(row_element):
     owner_anchor = owner_cell.find('a')
     if owner_anchor and owner_anchor.has_attr('href'):
         domain_data['owner_name'] = owner_anchor.get_text(strip=True)
-        owner_id_match = re.search(r'user_id=(\d+)', owner_anchor['href'])
+        owner_id_match = USER_ID_RE.search(owner_anchor['href'])
         domain_data['owner_id'] = int(owner_id_match.group(1)) if owner_id_match else None
     else: 
         domain_data['owner_name'] = owner_cell.get_text(strip=True)
@@ -214,12 +625,13 @@ def parse_domain_row(row_element):
     age_text = cells[3].get_text(strip=True)
     domain_data['age_raw_text'] = age_text
     domain_data['date_added'] = parse_date_from_age(age_text)
-    days_ago_match = re.search(r'(\d+)\s+days\s+ago', age_text)
+    days_ago_match = DAYS_AGO_RE.search(age_text)
     domain_data['age_days'] = int(days_ago_match.group(1)) if days_ago_match else None
     return domain_data
 
-def get_total_pages(html_content):
-    soup = BeautifulSoup(html_content, 'lxml')
+def get_total_pages(html_content, soup=None):
+    if soup is None:
+        soup = BeautifulSoup(html_content, 'lxml')
     page_input_form = soup.find('form', action='/domain/registry/')
     if page_input_form:
         font_tag_containing_page_info = None
@@ -263,9 +675,18 @@ def get_total_pages(html_content):
     return 1
 
 def process_html_content(page_num, html_content):
+    """Extracts the domain rows of one registry page with the configured PARSE_ENGINE."""
+    if PARSE_ENGINE == "lxml" and lxml_html is not None:
+        return process_html_content_lxml(page_num, html_content)
+    if PARSE_ENGINE == "parity" and lxml_html is not None:
+        return check_parse_parity(page_num, html_content)
+    return process_html_content_bs4(page_num, html_content)
+
+def process_html_content_bs4(page_num, html_content, soup=None):
     page_data = []
     if not html_content: return page_data
-    soup = BeautifulSoup(html_content, 'lxml')
+    if soup is None:
+        soup = BeautifulSoup(html_content, 'lxml')
     data_table = None
     center_tags = soup.find_all('center')
     for center_tag in center_tags:
@@ -291,94 +712,1729 @@ def process_html_content(page_num, html_content):
         print(f"Could not find the main data table on page {page_num}.")
     return page_data
 
-def load_previous_first_seen():
-    """Load first_seen dates from the previous fraidex.json run (keyed by domain_id)."""
+# --- lxml engine: compiled XPath mirroring the BeautifulSoup lookups above ---
+if etree is not None:
+    _HAS_ROW_CLASS = "contains(concat(' ', normalize-space(@class), ' '), ' trl ') or contains(concat(' ', normalize-space(@class), ' '), ' trd ')"
+    XP_CENTERS_IN_WHITE_TD = etree.XPath("//td[@bgcolor='white']/center")
+    XP_FIRST_DATA_TABLE = etree.XPath("(.//table[@width='90%' and @border='0'])[1]")
+    XP_DATA_ROWS = etree.XPath(f".//tr[{_HAS_ROW_CLASS}]")
+    XP_PAGE_INPUT = etree.XPath(".//input[@name='page']")
+    XP_CELLS = etree.XPath(".//td")
+    XP_FIRST_ANCHOR = etree.XPath("(.//a)[1]")
+    XP_FIRST_SPAN = etree.XPath("(.//span)[1]")
+    XP_FIRST_BLANK_ANCHOR = etree.XPath("(.//a[@target='_blank'])[1]")
+    XP_TEXT = etree.XPath(".//text()")
+    # get_total_pages lookups
+    XP_REGISTRY_FORM = etree.XPath("(//form[@action='/domain/registry/'])[1]")
+    XP_PARENT_TD = etree.XPath("ancestor::td[1]")
+    XP_FONTS = etree.XPath(".//font")
+    XP_TITLE = etree.XPath("(//title)[1]")
+    XP_FONTS_IN_FULL_WIDTH_TABLE = etree.XPath("//font[ancestor::table[@width='100%']]")
+    XP_BOLDS = etree.XPath(".//b")
+
+PAGE_OF_RE = re.compile(r'Page\s+\d*\s+of\s+\d+')
+
+def _lxml_text(element):
+    """Equivalent of BeautifulSoup's get_text(strip=True)."""
+    return ''.join(text.strip() for text in XP_TEXT(element))
+
+def _first(xpath, element):
+    found = xpath(element)
+    return found[0] if found else None
+
+def parse_domain_row_lxml(row_element):
+    cells = XP_CELLS(row_element)
+    if len(cells) != 4: return None
+    domain_data = {}
+    domain_cell = cells[0]
+    domain_anchor = _first(XP_FIRST_ANCHOR, domain_cell)
+    if domain_anchor is not None and domain_anchor.get('href') is not None:
+        domain_data['domain_name'] = _lxml_text(domain_anchor)
+        domain_id_match = DOMAIN_ID_RE.search(domain_anchor.get('href'))
+        domain_data['domain_id'] = int(domain_id_match.group(1)) if domain_id_match else None
+    else:
+        domain_text = _lxml_text(domain_cell)
+        domain_data['domain_name'] = domain_text.split('\n')[0] if domain_text else None
+        domain_data['domain_id'] = None
+
+    span_tag = _first(XP_FIRST_SPAN, domain_cell)
+    if span_tag is not None:
+        hosts_match = HOSTS_IN_USE_RE.search(_lxml_text(span_tag))
+        domain_data['hosts_in_use'] = int(hosts_match.group(1)) if hosts_match else 0
+        website_anchor = _first(XP_FIRST_BLANK_ANCHOR, span_tag)
+        domain_data['website'] = website_anchor.get('href') if website_anchor is not None else None
+    else:
+        domain_data['hosts_in_use'] = 0
+        domain_data['website'] = None
+    domain_data['status'] = _lxml_text(cells[1])
+    owner_cell = cells[2]
+    owner_anchor = _first(XP_FIRST_ANCHOR, owner_cell)
+    if owner_anchor is not None and owner_anchor.get('href') is not None:
+        domain_data['owner_name'] = _lxml_text(owner_anchor)
+        owner_id_match = USER_ID_RE.search(owner_anchor.get('href'))
+        domain_data['owner_id'] = int(owner_id_match.group(1)) if owner_id_match else None
+    else:
+        domain_data['owner_name'] = _lxml_text(owner_cell)
+        domain_data['owner_id'] = None
+    age_text = _lxml_text(cells[3])
+    domain_data['age_raw_text'] = age_text
+    domain_data['date_added'] = parse_date_from_age(age_text)
+    days_ago_match = DAYS_AGO_RE.search(age_text)
+    domain_data['age_days'] = int(days_ago_match.group(1)) if days_ago_match else None
+    return domain_data
+
+def _soup_string(element):
+    """BeautifulSoup's .string: the text of an element whose only child is one string (or one such element)."""
+    if len(element) == 0:
+        return element.text
+    if len(element) == 1 and not element.text and not element[0].tail:
+        return _soup_string(element[0])
+    return None
+
+def get_total_pages_lxml(root):
+    """get_total_pages on an lxml.html tree, so the lxml engine parses page 1 only once."""
+    def has_page_info(font):
+        string = _soup_string(font)
+        return string is not None and PAGE_OF_RE.search(string)
+
+    page_input_form = _first(XP_REGISTRY_FORM, root)
+    if page_input_form is not None:
+        font_tag_containing_page_info = None
+        form_parent_td = _first(XP_PARENT_TD, page_input_form)
+        if form_parent_td is not None:
+            font_tag_containing_page_info = next((font for font in XP_FONTS(form_parent_td) if has_page_info(font)), None)
+        if font_tag_containing_page_info is None:
+            all_font_tags = [font for font in XP_FONTS(root) if has_page_info(font)]
+            if all_font_tags: font_tag_containing_page_info = all_font_tags[-1]
+        if font_tag_containing_page_info is not None:
+            text_content = ' '.join(text.strip() for text in XP_TEXT(font_tag_containing_page_info) if text.strip())
+            match = re.search(r'of\s*(\d+)', text_content)
+            if match:
+                return int(match.group(1))
+    title_tag = _first(XP_TITLE, root)
+    if title_tag is not None:
+        match = re.search(r'Page\s+\d+\s+of\s+(\d+)', _lxml_text(title_tag))
+        if match:
+            return int(match.group(1))
+    for font in XP_FONTS_IN_FULL_WIDTH_TABLE(root):
+        font_text = ''.join(XP_TEXT(font))
+        if "Showing" not in font_text or "total" not in font_text:
+            continue
+        bold_tags = XP_BOLDS(font)
+        if len(bold_tags) >= 3:
+            total_items_str = _lxml_text(bold_tags[-1]).replace(',', '')
+            start_item_str = _lxml_text(bold_tags[0]).replace(',', '')
+            end_item_str = _lxml_text(bold_tags[1]).replace(',', '')
+            if total_items_str.isdigit():
+                total_items = int(total_items_str)
+                if start_item_str.isdigit() and end_item_str.isdigit():
+                    items_on_page = (int(end_item_str) - int(start_item_str)) + 1
+                    if items_on_page > 0: return (total_items + items_on_page - 1) // items_on_page
+                return (total_items + 99) // 100
+        break # get_total_pages only looks at the first matching font
+    print("Warning: Could not reliably determine total number of pages. Defaulting to 1.")
+    return 1
+
+def parse_lxml_document(page_num, html_content):
+    """The lxml.html tree of a page, or None (with a message) if lxml cannot parse it."""
+    if not html_content: return None
+    try:
+        return lxml_html.document_fromstring(html_content)
+    except (etree.ParserError, ValueError) as e:
+        print(f"Could not parse page {page_num} with lxml: {e}")
+        return None
+
+def process_html_content_lxml(page_num, html_content, root=None):
+    """Same records as process_html_content_bs4, extracted with compiled XPath and no soup tree."""
+    page_data = []
+    if root is None:
+        root = parse_lxml_document(page_num, html_content)
+    if root is None:
+        return page_data
+    data_table = None
+    for center_tag in XP_CENTERS_IN_WHITE_TD(root):
+        table_candidate = _first(XP_FIRST_DATA_TABLE, center_tag)
+        if table_candidate is not None and XP_DATA_ROWS(table_candidate) and not XP_PAGE_INPUT(table_candidate):
+            data_table = table_candidate
+            break
+    if data_table is None:
+        data_table = _first(XP_FIRST_DATA_TABLE, root)
+    if data_table is not None:
+        for row in XP_DATA_ROWS(data_table):
+            domain_info = parse_domain_row_lxml(row)
+            if domain_info:
+                domain_info['source_page_number'] = page_num
+                page_data.append(domain_info)
+    else:
+        print(f"Could not find the main data table on page {page_num}.")
+    return page_data
+
+def check_parse_parity(page_num, html_content, soup=None, total_pages=None):
+    """Runs both parse engines on one page, reports any differing fields and returns the bs4 rows.
+
+    Given the bs4 total_pages (page 1), the lxml page count is checked against it too.
+    """
+    bs4_rows = process_html_content_bs4(page_num, html_content, soup)
+    root = parse_lxml_document(page_num, html_content)
+    lxml_rows = process_html_content_lxml(page_num, html_content, root) if root is not None else []
+    if total_pages is not None and root is not None:
+        lxml_total_pages = get_total_pages_lxml(root)
+        if lxml_total_pages != total_pages:
+            print(f"Parity mismatch on page {page_num}: bs4 found {total_pages} total pages, lxml found {lxml_total_pages}.")
+    if len(bs4_rows) != len(lxml_rows):
+        print(f"Parity mismatch on page {page_num}: bs4 found {len(bs4_rows)} rows, lxml found {len(lxml_rows)}.")
+    for row_index, (bs4_row, lxml_row) in enumerate(zip(bs4_rows, lxml_rows)):
+        for field in sorted(set(bs4_row) | set(lxml_row)):
+            if bs4_row.get(field) != lxml_row.get(field):
+                print(f"Parity mismatch on page {page_num}, row {row_index} ({bs4_row.get('domain_name')}), "
+                      f"field '{field}': bs4={bs4_row.get(field)!r} lxml={lxml_row.get(field)!r}")
+    return bs4_rows
+
+def load_previous_data():
+    """Load the rows of the previous fraidex.json run (None if there is no usable previous run)."""
     if not os.path.exists(PREVIOUS_JSON_FILE):
         print(f"No previous data file found at {PREVIOUS_JSON_FILE}. All domains will be marked as new.")
-        return {}
+        return None
     try:
         with open(PREVIOUS_JSON_FILE, 'r', encoding='utf-8') as f:
-            prev_data = json.load(f)
-        seen_map = {}
-        for entry in prev_data:
-            did = entry.get('domain_id')
-            fs = entry.get('first_seen')
-            if did is not None and fs:
-                seen_map[did] = fs
-        print(f"Loaded {len(seen_map)} previously-seen domain records.")
-        return seen_map
+            return json.load(f)
     except (IOError, json.JSONDecodeError) as e:
         print(f"Warning: could not read previous data file: {e}")
+        return None
+
+def previous_page_count(prev_data):
+    """Highest source_page_number in the previous snapshot (None without one)."""
+    return max((entry.get('source_page_number') or 0 for entry in prev_data or []), default=0) or None
+
+def load_previous_first_seen(prev_data=None):
+    """Load first_seen dates from the previous fraidex.json run (keyed by domain_id)."""
+    if prev_data is None:
+        prev_data = load_previous_data() or []
+    seen_map = {}
+    for entry in prev_data:
+        did = entry.get('domain_id')
+        fs = entry.get('first_seen')
+        if did is not None and fs:
+            seen_map[did] = fs
+    print(f"Loaded {len(seen_map)} previously-seen domain records.")
+    return seen_map
+
+def file_sha256(path):
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_fraidex_age_days(first_seen):
+    try:
+        fs_date = datetime.strptime(first_seen, '%Y-%m-%d')
+        return (datetime.utcnow() - fs_date).days
+    except ValueError:
+        return 0
+
+def diff_row(previous, entry):
+    """Fields of entry that differ from previous (None for dropped fields), minus PATCH_IGNORED_FIELDS."""
+    fields = {
+        field: value for field, value in entry.items()
+        if field not in PATCH_IGNORED_FIELDS and previous.get(field) != value
+    }
+    fields.update({field: None for field in previous if field not in entry and field not in PATCH_IGNORED_FIELDS})
+    return fields
+
+def build_patch(prev_data, all_domains_data):
+    """Keyed diff by domain_id: full rows for added domains, ids for removed ones, and only the
+    differing fields (minus PATCH_IGNORED_FIELDS) for changed ones. Rows without an id are skipped."""
+    previous_by_id = {entry['domain_id']: entry for entry in prev_data or [] if entry.get('domain_id') is not None}
+    current_ids = set()
+    added, changed = [], []
+    for entry in all_domains_data:
+        did = entry.get('domain_id')
+        if did is None:
+            continue
+        current_ids.add(did)
+        previous = previous_by_id.get(did)
+        if previous is None:
+            added.append(entry)
+            continue
+        fields = diff_row(previous, entry)
+        if fields:
+            changed.append({'domain_id': did, 'fields': fields})
+    removed = sorted(did for did in previous_by_id if did not in current_ids)
+    return {'added': added, 'removed': removed, 'changed': changed}
+
+class HistoryStore:
+    """Indexed SQLite store of domain state across runs.
+
+    domains keeps the latest row of every domain ever seen with its first_seen/last_seen, and
+    domain_history gets a (hosts_in_use, status) point whenever either value changes, e.g.
+    SELECT observed_at, hosts_in_use FROM domain_history WHERE domain_id = ? ORDER BY run_id
+    gives the hosts growth of one domain. runs.snapshot_sha256 is the hash of the fraidex.json a run
+    published, so a patch is only diffed against the store when its latest run is the patch's base.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at TEXT NOT NULL,
+            domain_count INTEGER NOT NULL DEFAULT 0,
+            snapshot_sha256 TEXT
+        );
+        CREATE TABLE IF NOT EXISTS domains (
+            domain_id INTEGER PRIMARY KEY,
+            first_seen TEXT NOT NULL,
+            last_seen TEXT NOT NULL,
+            last_run_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            row_json TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS domains_by_run ON domains (last_run_id, position);
+        CREATE TABLE IF NOT EXISTS domain_history (
+            domain_id INTEGER NOT NULL,
+            run_id INTEGER NOT NULL,
+            observed_at TEXT NOT NULL,
+            hosts_in_use INTEGER,
+            status TEXT,
+            PRIMARY KEY (domain_id, run_id)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, connection, path):
+        self.connection = connection
+        self.path = path
+        self.run_id = None
+
+    @classmethod
+    def open(cls, path):
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(cls.SCHEMA)
+        if 'snapshot_sha256' not in [column[1] for column in connection.execute("PRAGMA table_info(runs)")]:
+            # Stores created before runs recorded their snapshot hash
+            connection.execute("ALTER TABLE runs ADD COLUMN snapshot_sha256 TEXT")
+        print(f"Opened history store {path}.")
+        return cls(connection, path)
+
+    def close(self):
+        self.connection.close()
+
+    def is_empty(self):
+        return self.connection.execute("SELECT 1 FROM runs LIMIT 1").fetchone() is None
+
+    def import_snapshot(self, prev_data, snapshot_sha256=None):
+        """Seeds an empty store with a previous fraidex.json (whose hash is snapshot_sha256) so first_seen dates carry over."""
+        self.record_run(prev_data, datetime.utcnow().strftime('%Y-%m-%d'), imported=True)
+        self.record_snapshot_hash(snapshot_sha256)
+        print(f"Imported {len(prev_data)} rows from the previous snapshot into the history store.")
+
+    def record_run(self, all_domains_data, today_str, imported=False, base_sha256=None):
+        """Upserts this run's rows in batches, setting first_seen/fraidex_age_days on each entry.
+
+        Returns (diff against the previous run in build_patch's shape, previous run's row count or None).
+        The diff is only taken from the store if the previous run published the snapshot whose hash is
+        base_sha256 (both None for a first run); otherwise (None, None) is returned and the caller diffs
+        against the snapshot itself.
+        """
+        cursor = self.connection.cursor()
+        previous_run = cursor.execute("SELECT run_id, domain_count, snapshot_sha256 FROM runs ORDER BY run_id DESC LIMIT 1").fetchone()
+        if previous_run is None:
+            base_matches = base_sha256 is None
+        else:
+            base_matches = base_sha256 is not None and previous_run[2] == base_sha256
+        run_started_at = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        cursor.execute("INSERT INTO runs (started_at) VALUES (?)", (run_started_at,))
+        run_id = cursor.lastrowid
+        previous_run_id = previous_run[0] if previous_run else None
+
+        added, changed = [], []
+        keyed_rows = [(position, entry) for position, entry in enumerate(all_domains_data) if entry.get('domain_id') is not None]
+        for batch_start in range(0, len(keyed_rows), HISTORY_BATCH_SIZE):
+            batch = keyed_rows[batch_start:batch_start + HISTORY_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            stored = {
+                row[0]: row[1:] for row in cursor.execute(
+                    f"SELECT domain_id, first_seen, last_run_id, row_json FROM domains WHERE domain_id IN ({placeholders})",
+                    [entry['domain_id'] for _, entry in batch])
+            }
+            domain_rows, history_rows = [], []
+            for position, entry in batch:
+                did = entry['domain_id']
+                stored_row = stored.get(did)
+                previous = json.loads(stored_row[2]) if stored_row else None
+                if imported:
+                    first_seen = entry.get('first_seen') or today_str
+                else:
+                    first_seen = stored_row[0] if stored_row else today_str
+                entry['first_seen'] = first_seen
+                entry['fraidex_age_days'] = get_fraidex_age_days(first_seen)
+                if previous is None or stored_row[1] != previous_run_id:
+                    added.append(entry)
+                else:
+                    fields = diff_row(previous, entry)
+                    if fields:
+                        changed.append({'domain_id': did, 'fields': fields})
+                if previous is None or (previous.get('hosts_in_use'), previous.get('status')) != (entry.get('hosts_in_use'), entry.get('status')):
+                    history_rows.append((did, run_id, run_started_at, entry.get('hosts_in_use'), entry.get('status')))
+                domain_rows.append((did, first_seen, today_str, run_id, position, json.dumps(entry, ensure_ascii=False)))
+            cursor.executemany(
+                "INSERT INTO domains (domain_id, first_seen, last_seen, last_run_id, position, row_json) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (domain_id) DO UPDATE SET last_seen = excluded.last_seen, last_run_id = excluded.last_run_id, "
+                "position = excluded.position, row_json = excluded.row_json",
+                domain_rows)
+            cursor.executemany(
+                "INSERT OR REPLACE INTO domain_history (domain_id, run_id, observed_at, hosts_in_use, status) VALUES (?, ?, ?, ?, ?)",
+                history_rows)
+
+        removed = []
+        if previous_run_id is not None:
+            # Anything still stamped with the previous run was not seen in this one
+            removed = [row[0] for row in cursor.execute(
+                "SELECT domain_id FROM domains WHERE last_run_id = ? ORDER BY domain_id", (previous_run_id,))]
+        cursor.execute("UPDATE runs SET domain_count = ? WHERE run_id = ?", (len(all_domains_data), run_id))
+        self.connection.commit()
+        self.run_id = run_id
+        if not base_matches:
+            return None, None
+        return {'added': added, 'removed': removed, 'changed': changed}, (previous_run[1] if previous_run else None)
+
+    def record_snapshot_hash(self, snapshot_sha256):
+        """Stores the hash of the fraidex.json this run published."""
+        self.connection.execute("UPDATE runs SET snapshot_sha256 = ? WHERE run_id = ?", (snapshot_sha256, self.run_id))
+        self.connection.commit()
+
+    def previous_rows_by_page(self, page_nums):
+        """The latest run's stored rows for the given source pages, keyed by page number (rows without an id are not stored)."""
+        placeholders = ','.join('?' * len(page_nums))
+        rows_by_page = {}
+        for (row_json,) in self.connection.execute(
+                "SELECT row_json FROM domains WHERE last_run_id = (SELECT MAX(run_id) FROM runs) "
+                f"AND json_extract(row_json, '$.source_page_number') IN ({placeholders}) ORDER BY position", list(page_nums)):
+            entry = json.loads(row_json)
+            rows_by_page.setdefault(entry['source_page_number'], []).append(entry)
+        return rows_by_page
+
+    def previous_page_count(self):
+        """Highest source_page_number of the latest run (None for an empty store)."""
+        return self.connection.execute(
+            "SELECT MAX(json_extract(row_json, '$.source_page_number')) FROM domains "
+            "WHERE last_run_id = (SELECT MAX(run_id) FROM runs)").fetchone()[0]
+
+    def write_snapshot(self, path, all_domains_data):
+        """Streams the latest run's rows from the store into path, in the same layout as json.dump(..., indent=2).
+
+        Rows without a domain_id are not stored, so they are merged back in from all_domains_data by position.
+        """
+        stored_rows = self.connection.execute(
+            "SELECT position, row_json FROM domains WHERE last_run_id = ? ORDER BY position", (self.run_id,))
+        stored_rows = ((position, json.loads(row_json)) for position, row_json in stored_rows)
+        unkeyed_rows = [(position, entry) for position, entry in enumerate(all_domains_data) if entry.get('domain_id') is None]
+        count = 0
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('[')
+            for _, entry in heapq.merge(stored_rows, unkeyed_rows, key=lambda item: item[0]):
+                f.write(',\n  ' if count else '\n  ')
+                f.write(json.dumps(entry, indent=2, ensure_ascii=False).replace('\n', '\n  '))
+                count += 1
+            f.write('\n]' if count else ']')
+        return count
+
+
+class PageCache:
+    """On-disk cache of registry pages keyed by page number.
+
+    Each entry keeps the ETag/Last-Modified validators (when freedns sends them), a hash of
+    the page HTML and the rows parsed from it.
+    """
+
+    def __init__(self, path, entries=None):
+        self.path = path
+        self.entries = entries or {}
+        self.validators = {}
+        self.content_hashes = {}
+        self.not_modified_count = 0
+        self.unchanged_count = 0
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            print(f"No page cache found at {path}. Every page will be parsed.")
+            return cls(path)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get('version') != PAGE_CACHE_VERSION:
+                print(f"Ignoring page cache {path} written by another cache version.")
+                return cls(path)
+            entries = {int(page_num): entry for page_num, entry in cached.get('pages', {}).items()}
+            print(f"Loaded page cache with {len(entries)} pages.")
+            return cls(path, entries)
+        except (IOError, ValueError, AttributeError) as e:
+            print(f"Warning: could not read page cache {path}: {e}")
+            return cls(path)
+
+    def conditional_headers(self, page_num):
+        """If-None-Match/If-Modified-Since headers for a cached page (never for page 1, whose HTML is always needed)."""
+        entry = self.entries.get(page_num)
+        if page_num == 1 or not entry:
+            return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def record_validators(self, page_num, response_headers):
+        etag = response_headers.get('ETag')
+        last_modified = response_headers.get('Last-Modified')
+        if etag or last_modified:
+            self.validators[page_num] = {'etag': etag, 'last_modified': last_modified}
+
+    def cached_rows(self, page_num, html_content):
+        """Returns the cached rows if the page is unchanged (304 or same content hash), else None."""
+        entry = self.entries.get(page_num)
+        if html_content is NOT_MODIFIED:
+            if entry is None:
+                return None
+            self.not_modified_count += 1
+            self.content_hashes[page_num] = entry['content_hash']
+            return entry['rows']
+        content_hash = hashlib.sha256(html_content.encode('utf-8')).hexdigest()
+        self.content_hashes[page_num] = content_hash
+        if entry is not None and entry.get('content_hash') == content_hash:
+            self.unchanged_count += 1
+            return entry['rows']
+        return None
+
+    def update(self, page_num, rows):
+        if page_num not in self.content_hashes:
+            return
+        entry = {'content_hash': self.content_hashes[page_num], 'rows': rows}
+        entry.update(self.validators.get(page_num) or {
+            key: self.entries.get(page_num, {}).get(key) for key in ('etag', 'last_modified')
+        })
+        self.entries[page_num] = entry
+
+    def save(self, page_nums):
+        """Writes the entries of this run's pages (dropping pages that no longer exist) to disk."""
+        pages = {str(page_num): self.entries[page_num] for page_num in sorted(page_nums) if page_num in self.entries}
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump({'version': PAGE_CACHE_VERSION, 'pages': pages}, f, ensure_ascii=False)
+            print(f"Reused cached rows for {self.not_modified_count + self.unchanged_count} pages "
+                  f"({self.not_modified_count} not modified, {self.unchanged_count} unchanged content).")
+        except IOError as e:
+            print(f"Error writing page cache {self.path}: {e}")
+
+class CrawlJournal:
+    """Append-only checkpoint of the pages a crawl has finished.
+
+    The first line is a header with the registry's page count, every following line is one
+    {"page": n, "rows": [...]} record. A torn last line (the process died mid-write) is dropped on
+    load, and a journal is only resumed by a crawl that sees the same page count.
+    """
+
+    def __init__(self, path, total_pages=None, pages=None, valid_bytes=0):
+        self.path = path
+        self.lock = threading.Lock()
+        self.total_pages = total_pages
+        self.pages = pages or {}
+        self.valid_bytes = valid_bytes
+        self.resumed = {}
+        self.missing_pages = []
+        self.file = None
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return cls(path)
+        age_seconds = time.time() - os.path.getmtime(path)
+        if age_seconds > JOURNAL_MAX_AGE_SECONDS:
+            print(f"Ignoring crawl journal {path}: last written {age_seconds / 60:.0f} minutes ago.")
+            return cls(path)
+        total_pages, pages, valid_bytes = None, {}, 0
+        try:
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b'\n'):
+                        break
+                    if total_pages is None:
+                        if record.get('version') != JOURNAL_VERSION:
+                            print(f"Ignoring crawl journal {path} written by another journal version.")
+                            return cls(path)
+                        total_pages = record['total_pages']
+                    else:
+                        pages[record['page']] = record['rows']
+                    valid_bytes += len(line)
+        except (IOError, KeyError, AttributeError, TypeError) as e:
+            print(f"Warning: could not read crawl journal {path}: {e}")
+            return cls(path)
+        return cls(path, total_pages, pages, valid_bytes)
+
+    def start(self, total_pages):
+        """Opens the journal for this crawl and returns the pages (other than page 1) it already has."""
+        try:
+            if self.total_pages == total_pages and self.pages:
+                self.file = open(self.path, 'r+b')
+                self.file.truncate(self.valid_bytes) # Drop a torn last record before appending
+                self.file.seek(self.valid_bytes)
+                self.resumed = {page_num: rows for page_num, rows in self.pages.items() if 1 < page_num <= total_pages}
+                print(f"Resuming from crawl journal {self.path}: {len(self.resumed)} of {total_pages - 1} pages already done.")
+            else:
+                if self.total_pages is not None:
+                    print(f"Discarding crawl journal {self.path}: it was written for {self.total_pages} pages, not {total_pages}.")
+                self.file = open(self.path, 'wb')
+                self._append({'version': JOURNAL_VERSION, 'total_pages': total_pages,
+                              'started_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')})
+        except (IOError, OSError) as e:
+            print(f"Warning: could not open crawl journal {self.path}, crawling without it: {e}")
+            self.file = None
+        self.total_pages = total_pages
+        return self.resumed
+
+    def _append(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record(self, page_num, rows):
+        with self.lock:
+            if self.file is None:
+                return
+            try:
+                self._append({'page': page_num, 'rows': rows})
+            except (IOError, OSError) as e:
+                print(f"Warning: could not append page {page_num} to crawl journal {self.path}: {e}")
+
+    def record_future(self, page_num, future):
+        """Done-callback for parses running in the process pool."""
+        if not future.cancelled() and future.exception() is None:
+            self.record(page_num, future.result()[0])
+
+    def finish(self):
+        """Closes the journal; it is removed unless pages are still missing, so a rerun can fill them in."""
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.close()
+            self.file = None
+        if self.missing_pages:
+            print(f"Keeping crawl journal {self.path}: a rerun will only fetch the {len(self.missing_pages)} missing pages.")
+        else:
+            os.remove(self.path)
+
+def percentiles(values, quantiles=(0.5, 0.9, 0.99)):
+    """Nearest-rank percentiles plus count/mean/max of a list of numbers (empty dict for no values)."""
+    if not values:
         return {}
+    ordered = sorted(values)
+    summary = {f"p{int(q * 100)}": ordered[max(0, math.ceil(q * len(ordered)) - 1)] for q in quantiles}
+    summary.update({'count': len(ordered), 'mean': sum(ordered) / len(ordered), 'max': ordered[-1]})
+    return summary
 
+class CrawlMetrics:
+    """Per-page crawl instrumentation.
 
-def main():
-    start_time = time.time()
-    all_domains_data = []
-    today_str = datetime.utcnow().strftime('%Y-%m-%d')
-    previous_first_seen = load_previous_first_seen()
-    
-    with requests.Session() as session:
+    Records fetch latency, attempts, backoff slept, response bytes and status codes per page from
+    the fetchers, and parse time and rows from the parse stage; write() turns them into a JSON
+    summary with percentiles and a Prometheus textfile.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.started_at = time.time()
+
+    def _page(self, page_num):
+        return self.pages.setdefault(page_num, {
+            'page': page_num, 'fetched': False, 'cached': False, 'attempts': 0, 'fetch_seconds': 0.0,
+            'backoff_seconds': 0.0, 'response_bytes': 0, 'status_codes': [], 'parse_seconds': None, 'rows': None,
+            'resumed': False, 'carried_over': False,
+        })
+
+    def record_attempt(self, page_num, status_label, seconds, response_bytes, ok):
+        with self.lock:
+            page = self._page(page_num)
+            page['attempts'] += 1
+            page['fetch_seconds'] += seconds
+            page['response_bytes'] += response_bytes
+            page['status_codes'].append(status_label)
+            page['fetched'] = page['fetched'] or ok
+
+    def record_backoff(self, page_num, seconds):
+        with self.lock:
+            self._page(page_num)['backoff_seconds'] += seconds
+
+    def record_parse(self, page_num, seconds, rows, cached=False):
+        with self.lock:
+            page = self._page(page_num)
+            page['parse_seconds'] = seconds
+            page['rows'] = rows
+            page['cached'] = cached
+
+    def record_carried_rows(self, page_num, rows, resumed=False):
+        """Rows taken from the crawl journal (resumed) or from the previous snapshot instead of this run's fetch."""
+        with self.lock:
+            page = self._page(page_num)
+            page['rows'] = rows
+            page['resumed' if resumed else 'carried_over'] = True
+
+    def summary(self):
+        with self.lock:
+            pages = [dict(page) for _, page in sorted(self.pages.items())]
+        status_counts = {}
+        for page in pages:
+            for status_label in page['status_codes']:
+                status_counts[status_label] = status_counts.get(status_label, 0) + 1
+        fetched = [page for page in pages if page['fetched']]
+        return {
+            'generated_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'wall_seconds': time.time() - self.started_at,
+            'pages': {
+                'total': len(pages),
+                'fetched': len(fetched),
+                'failed': sum(1 for page in pages if not page['fetched'] and not page['resumed']),
+                'cached': sum(1 for page in pages if page['cached']),
+                'resumed': sum(1 for page in pages if page['resumed']),
+                'carried_over': sum(1 for page in pages if page['carried_over']),
+            },
+            'totals': {
+                'attempts': sum(page['attempts'] for page in pages),
+                'retries': sum(max(0, page['attempts'] - 1) for page in pages),
+                'backoff_seconds': sum(page['backoff_seconds'] for page in pages),
+                'response_bytes': sum(page['response_bytes'] for page in pages),
+                'rows': sum(page['rows'] or 0 for page in pages),
+            },
+            'status_codes': dict(sorted(status_counts.items())),
+            'fetch_seconds': percentiles([page['fetch_seconds'] for page in fetched]),
+            'parse_seconds': percentiles([page['parse_seconds'] for page in pages if page['parse_seconds'] is not None]),
+            'attempts': percentiles([page['attempts'] for page in pages]),
+            'backoff_seconds': percentiles([page['backoff_seconds'] for page in pages]),
+            'slowest_pages': sorted(pages, key=lambda page: page['fetch_seconds'] + page['backoff_seconds'], reverse=True)[:METRICS_SLOWEST_PAGES],
+            'per_page': pages,
+        }
+
+    @staticmethod
+    def prometheus_text(summary):
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP fraidex_crawl_{name} {help_text}")
+            lines.append(f"# TYPE fraidex_crawl_{name} {metric_type}")
+            for labels, value in samples:
+                label_text = '{' + ','.join(f'{key}="{val}"' for key, val in labels.items()) + '}' if labels else ''
+                lines.append(f"fraidex_crawl_{name}{label_text} {value}")
+
+        def summary_samples(name, stats):
+            samples = [({'quantile': q}, stats[f'p{int(float(q) * 100)}']) for q in ('0.5', '0.9', '0.99')] if stats else []
+            metric(name, 'summary', f"Per-page {name.replace('_', ' ')}.", samples)
+            lines.append(f"fraidex_crawl_{name}_sum {stats['mean'] * stats['count'] if stats else 0}")
+            lines.append(f"fraidex_crawl_{name}_count {stats['count'] if stats else 0}")
+
+        metric('last_run_timestamp_seconds', 'gauge', "Unix time the crawl summary was written.", [({}, int(time.time()))])
+        metric('duration_seconds', 'gauge', "Wall time of the crawl.", [({}, summary['wall_seconds'])])
+        metric('pages', 'gauge', "Registry pages by outcome.", [({'state': state}, count) for state, count in summary['pages'].items()])
+        for name, value in summary['totals'].items():
+            metric(f"run_{name}", 'gauge', f"Total {name.replace('_', ' ')} in the run.", [({}, value)])
+        metric('responses', 'gauge', "Fetch attempts by HTTP status or error kind.",
+               [({'code': code}, count) for code, count in summary['status_codes'].items()])
+        summary_samples('fetch_seconds', summary['fetch_seconds'])
+        summary_samples('parse_seconds', summary['parse_seconds'])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path=None, prometheus_path=None):
+        json_path = json_path if json_path is not None else METRICS_JSON_FILE
+        prometheus_path = prometheus_path if prometheus_path is not None else METRICS_PROMETHEUS_FILE
+        summary = self.summary()
+        print(f"Crawl metrics: {summary['pages']['fetched']}/{summary['pages']['total']} pages fetched, "
+              f"{summary['totals']['retries']} retries, {summary['totals']['backoff_seconds']:.1f}s backoff, "
+              f"fetch p50/p99 {summary['fetch_seconds'].get('p50', 0):.2f}s/{summary['fetch_seconds'].get('p99', 0):.2f}s.")
+        try:
+            if json_path:
+                with open(json_path, 'w', encoding='utf-8') as f:
+                    json.dump(summary, f, indent=2)
+            if prometheus_path:
+                # Written to a temp file and renamed so a textfile collector never reads a partial file
+                with open(prometheus_path + '.tmp', 'w', encoding='utf-8') as f:
+                    f.write(self.prometheus_text(summary))
+                os.replace(prometheus_path + '.tmp', prometheus_path)
+        except IOError as e:
+            print(f"Error writing crawl metrics: {e}")
+
+def create_parse_executor():
+    """Returns a ProcessPoolExecutor for the parse stage, or None to parse inline on the consumer."""
+    if PARSE_WORKERS <= 0:
+        return None
+    return ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+
+def process_first_page(html_content):
+    """Page count and rows of page 1, timed. Both come from a single parse per engine: the lxml tree
+    for lxml, the soup for bs4 (parity adds the lxml tree it checks against)."""
+    started = time.perf_counter()
+    root = parse_lxml_document(1, html_content) if PARSE_ENGINE == "lxml" and lxml_html is not None else None
+    if root is not None:
+        total_pages = get_total_pages_lxml(root)
+        rows = process_html_content_lxml(1, html_content, root)
+    else:
+        soup = BeautifulSoup(html_content, 'lxml')
+        total_pages = get_total_pages(html_content, soup)
+        if PARSE_ENGINE == "parity" and lxml_html is not None:
+            rows = check_parse_parity(1, html_content, soup, total_pages)
+        else:
+            rows = process_html_content_bs4(1, html_content, soup)
+    return total_pages, rows, time.perf_counter() - started
+
+def process_html_content_timed(page_num, html_content):
+    """process_html_content plus how long it took, measured where the parse actually runs."""
+    started = time.perf_counter()
+    rows = process_html_content(page_num, html_content)
+    return rows, time.perf_counter() - started
+
+def submit_parse(parse_executor, page_num, html_content, page_cache=None, journal=None):
+    """Parses a page inline, or hands it to the parse pool and returns the pending Future.
+
+    Results are (rows, parse_seconds); unchanged pages short-circuit to (cached rows, None).
+    Returns None for a 304 with no cached rows to stand in, so the page counts as missing.
+    With a journal, the rows are appended to it as soon as they exist.
+    """
+    result = None
+    if page_cache is not None:
+        cached_rows = page_cache.cached_rows(page_num, html_content)
+        if cached_rows is not None:
+            result = cached_rows, None
+    if result is None and html_content is NOT_MODIFIED:
+        print(f"Page {page_num} was reported unchanged but is missing from the page cache.")
+        return None
+    if result is None:
+        if parse_executor is not None:
+            future = parse_executor.submit(process_html_content_timed, page_num, html_content)
+            if journal is not None:
+                future.add_done_callback(lambda done, page_num=page_num: journal.record_future(page_num, done))
+            return future
+        result = process_html_content_timed(page_num, html_content)
+    if journal is not None:
+        journal.record(page_num, result[0])
+    return result
+
+def resolve_parse(page_num, result, page_cache=None, metrics=None):
+    """Rows of a finished parse stage result (None if the parse failed), recorded in the metrics and page cache."""
+    if isinstance(result, Future):
+        try:
+            result = result.result()
+        except Exception as exc:
+            print(f'Page {page_num} generated an unexpected exception while parsing: {exc}')
+            return None
+    rows, parse_seconds = result
+    if metrics is not None:
+        metrics.record_parse(page_num, parse_seconds, len(rows), cached=parse_seconds is None)
+    if page_cache is not None:
+        page_cache.update(page_num, rows)
+    return rows
+
+def previous_rows_by_page(prev_data, page_nums):
+    """Copies of the previous snapshot's rows for the given source pages, keyed by page number."""
+    page_nums = set(page_nums)
+    rows_by_page = {}
+    for entry in prev_data or []:
+        if entry.get('source_page_number') in page_nums:
+            rows_by_page.setdefault(entry['source_page_number'], []).append(dict(entry))
+    return rows_by_page
+
+def handle_attempt_result(scheduler, metrics, page_num, html_content, error_msg):
+    """Reports one attempt's outcome to the scheduler. Returns True once the page is resolved."""
+    if html_content is not None:
+        scheduler.record_success(page_num)
+        return True
+    delay = scheduler.record_failure(page_num)
+    if delay is None:
+        return True
+    print(f"{error_msg} on attempt {scheduler.failures[page_num]}/{MAX_FETCH_RETRIES + 1}; retry deferred by {delay:.2f}s.")
+    if metrics is not None:
+        metrics.record_backoff(page_num, delay)
+    return False
+
+def report_progress(scheduler, detail=""):
+    resolved_count, total_tasks = scheduler.resolved_count(), len(scheduler.wanted)
+    if resolved_count % 20 == 0 or resolved_count == total_tasks:
+        print(f"Fetched {resolved_count}/{total_tasks} pages{detail}...")
+
+def announce_start(speculative_pages):
+    if speculative_pages:
+        print(f"Fetching page 1, and speculatively pages {speculative_pages[0]}-{speculative_pages[-1]} "
+              f"from the previous run's page count...")
+    else:
         print("Fetching page 1 to determine total pages...")
-        _, html_content_page1 = fetch_page_content(1, session)
-        if not html_content_page1:
-            print("Failed to fetch the first page. Exiting.")
+
+def fetch_pages_threaded(plan_pages, speculative_pages=(), page_cache=None, metrics=None):
+    """Fetches page 1 together with speculative_pages, then the pages plan_pages(page 1 HTML) returns,
+    on a fixed ThreadPoolExecutor.
+
+    Yields (page_num, html_content) for each wanted page: page 1 first, the others as they complete.
+    Speculative pages that arrive before page 1 are held back until the plan says they are wanted.
+    Raises CrawlError if page 1 cannot be fetched.
+    """
+    # Page 1 goes through the scheduler like any other page, so its retries respect the budget,
+    # the deadline and the circuit breaker
+    scheduler = create_retry_scheduler([1] + list(speculative_pages), provisional=True)
+    early_results = []
+    with create_session() as session, ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        announce_start(speculative_pages)
+        future_to_page_num = {}
+        while not scheduler.finished():
+            if scheduler.provisional and scheduler.gave_up_on(1):
+                raise CrawlError("Failed to fetch the first page.")
+            while len(future_to_page_num) < MAX_WORKERS:
+                page_num = scheduler.next_page()
+                if page_num is None:
+                    break
+                future_to_page_num[executor.submit(fetch_page_attempt, page_num, session, page_cache, metrics)] = page_num
+            if not future_to_page_num:
+                time.sleep(scheduler.wait_seconds())
+                continue
+            done, _ = wait(future_to_page_num, timeout=scheduler.wait_seconds(), return_when=FIRST_COMPLETED)
+            for future in done:
+                page_num = future_to_page_num.pop(future)
+                try:
+                    html_content, error_msg = future.result()
+                except Exception as exc:
+                    html_content, error_msg = None, f"Unexpected exception {exc!r} fetching page {page_num}"
+                if not handle_attempt_result(scheduler, metrics, page_num, html_content, error_msg):
+                    continue
+                if page_num == 1 and html_content is not None and scheduler.provisional:
+                    html_content_page1 = html_content
+                    pages_to_fetch_nums = plan_pages(html_content_page1)
+                    scheduler.replan(pages_to_fetch_nums, retry_budget_for(pages_to_fetch_nums))
+                    if pages_to_fetch_nums:
+                        print(f"Concurrently fetching {len(pages_to_fetch_nums)} pages ({scheduler.resolved_count()} already in) "
+                              f"with {MAX_WORKERS} workers (retry budget {scheduler.retry_budget}, deadline {CRAWL_DEADLINE_SECONDS}s)...")
+                    yield 1, html_content_page1
+                    for early_page_num, html_content in early_results:
+                        if scheduler.wants(early_page_num):
+                            yield early_page_num, html_content
+                    early_results = None
+                    continue
+                if early_results is not None:
+                    if html_content is not None:
+                        early_results.append((page_num, html_content))
+                    continue
+                report_progress(scheduler)
+                if html_content is not None and scheduler.wants(page_num):
+                    yield page_num, html_content
+    if scheduler.given_up:
+        print(f"Gave up on {len(scheduler.given_up)} pages: {sorted(scheduler.given_up)}")
+
+async def _async_fetch_worker(scheduler, deliver, stop_event, session, limiter, page_cache, metrics):
+    while not scheduler.finished() and not stop_event.is_set():
+        # Take a page only once a slot is free, so an open circuit breaker also stops queued workers
+        await limiter.acquire()
+        page_num = scheduler.next_page()
+        if page_num is None:
+            await limiter.release(None)
+            await asyncio.sleep(scheduler.wait_seconds())
+            continue
+        try:
+            html_content, error_msg = await fetch_page_attempt_async(page_num, session, limiter, page_cache, metrics)
+        except Exception as exc:
+            html_content, error_msg = None, f"Unexpected exception {exc!r} fetching page {page_num}"
+        if handle_attempt_result(scheduler, metrics, page_num, html_content, error_msg):
+            await deliver(page_num, html_content)
+
+async def _fetch_pages_async(plan_pages, speculative_pages, result_queue, stop_event, page_cache=None, metrics=None):
+    limiter = AdaptiveConcurrencyLimiter(ASYNC_INITIAL_CONCURRENCY, ASYNC_MIN_CONCURRENCY, ASYNC_MAX_CONCURRENCY)
+    scheduler = create_retry_scheduler([1] + list(speculative_pages), provisional=True)
+    early_results = []
+    page1_fetched = asyncio.Event()
+    page1 = []
+
+    async def put_result(item):
+        # The queue is bounded: a slow consumer blocks the put (off the loop), which stalls this
+        # worker and so applies backpressure to fetching instead of buffering raw HTML
+        await asyncio.to_thread(result_queue.put, item)
+
+    async def deliver(page_num, html_content):
+        # Everything here runs on the event loop thread, so early_results needs no lock
+        if page_num == 1 and scheduler.provisional:
+            if html_content is not None:
+                page1.append(html_content)
+                page1_fetched.set()
+            return
+        if scheduler.provisional:
+            if html_content is not None:
+                early_results.append((page_num, html_content))
             return
+        report_progress(scheduler, f" (concurrency {limiter.limit})")
+        if html_content is not None and scheduler.wants(page_num):
+            await put_result((page_num, html_content))
+
+    # One keep-alive pool sized to the concurrency ceiling, shared by every request of the run
+    connector = aiohttp.TCPConnector(limit=limiter.maximum, limit_per_host=limiter.maximum, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        announce_start(speculative_pages)
+        workers = [
+            asyncio.create_task(_async_fetch_worker(scheduler, deliver, stop_event, session, limiter, page_cache, metrics))
+            for _ in range(limiter.maximum)
+        ]
+        try:
+            while not page1_fetched.is_set():
+                # Given up on by a failed attempt or by the deadline
+                if scheduler.gave_up_on(1):
+                    raise CrawlError("Failed to fetch the first page.")
+                try:
+                    await asyncio.wait_for(page1_fetched.wait(), timeout=scheduler.wait_seconds())
+                except asyncio.TimeoutError:
+                    pass
+            html_content_page1 = page1[0]
+            # Parsed off the loop so speculative responses keep flowing meanwhile
+            pages_to_fetch_nums = await asyncio.to_thread(plan_pages, html_content_page1)
+            scheduler.replan(pages_to_fetch_nums, retry_budget_for(pages_to_fetch_nums))
+            if pages_to_fetch_nums:
+                print(f"Asynchronously fetching {len(pages_to_fetch_nums)} pages ({scheduler.resolved_count()} already in) "
+                      f"with adaptive concurrency "
+                      f"({limiter.minimum}-{limiter.maximum}, currently {limiter.limit}; "
+                      f"retry budget {scheduler.retry_budget}, deadline {CRAWL_DEADLINE_SECONDS}s)...")
+            await put_result((1, html_content_page1))
+            for early_page_num, html_content in early_results:
+                if scheduler.wants(early_page_num):
+                    await put_result((early_page_num, html_content))
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+    if scheduler.given_up:
+        print(f"Gave up on {len(scheduler.given_up)} pages: {sorted(scheduler.given_up)}")
+
+def fetch_pages_async(plan_pages, speculative_pages=(), page_cache=None, metrics=None):
+    """Same contract as fetch_pages_threaded, with the aiohttp crawl running on its own event loop thread.
+
+    Parsing happens on the consuming thread, so it never delays in-flight responses (or skews the
+    latency the limiter sees). At most 2 * ASYNC_MAX_CONCURRENCY fetched pages wait for the consumer.
+    """
+    result_queue = queue.Queue(maxsize=2 * ASYNC_MAX_CONCURRENCY)
+    stop_event = threading.Event()
+    failure = []
 
-        total_pages = get_total_pages(html_content_page1)
+    def run_event_loop():
+        try:
+            asyncio.run(_fetch_pages_async(plan_pages, speculative_pages, result_queue, stop_event, page_cache, metrics))
+        except BaseException as exc:
+            failure.append(exc)
+        finally:
+            result_queue.put(None)
+
+    fetch_thread = threading.Thread(target=run_event_loop, name="fraidex-async-fetch", daemon=True)
+    fetch_thread.start()
+    try:
+        while (result := result_queue.get()) is not None:
+            yield result
+    finally:
+        # Also reached when the consumer stops early; workers exit after their current attempt.
+        # Draining unblocks puts waiting on the full queue, including the final sentinel.
+        stop_event.set()
+        while fetch_thread.is_alive():
+            try:
+                result_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        fetch_thread.join()
+    if failure:
+        raise failure[0]
+
+def iter_crawl_pages(first_page=1, last_page=None, parse_executor=None, page_cache=None, metrics=None, journal=None,
+                     fallback_rows=None, predicted_pages=None, shard=None, crawl_plan=None):
+    """Crawls the registry and yields (page_num, rows) for each page as soon as its rows are parsed.
+
+    Pages come in completion order. Only first_page..last_page are crawled, clamped to the page count;
+    page 1 is always fetched since it carries that count. With predicted_pages (e.g. the previous
+    run's page count), pages up to it are fetched alongside page 1 and trimmed or extended once the
+    real count is known. Pages an interrupted run already finished come from the journal, and pages
+    still without rows at the end get fallback_rows(page_nums)'s rows, minus domains already yielded.
+    shard=(index, count) keeps only that contiguous slice of the range. crawl_plan, if given, is filled
+    with total_pages, the selected pages and the missing_pages. Raises CrawlError if page 1 cannot be fetched.
+    """
+    if CRAWL_MODE == "async" and aiohttp is None:
+        print("FRAIDEX_CRAWL_MODE=async requires aiohttp (pip install aiohttp). Falling back to the thread pool.")
+    fetch_pages = fetch_pages_async if CRAWL_MODE == "async" and aiohttp is not None else fetch_pages_threaded
+    plan = crawl_plan if crawl_plan is not None else {}
+
+    def select_pages(total_pages):
+        pages = range(max(1, first_page), min(total_pages, last_page or total_pages) + 1)
+        if shard is not None:
+            shard_index, shard_count = shard
+            pages = pages[len(pages) * shard_index // shard_count:len(pages) * (shard_index + 1) // shard_count]
+        return pages
+
+    def plan_pages(html_content_page1):
+        total_pages, rows, parse_seconds = process_first_page(html_content_page1)
         print(f"Total pages to scrape: {total_pages}")
+        if metrics is not None:
+            metrics.record_parse(1, parse_seconds, len(rows))
+        plan.update(total_pages=total_pages, selected=select_pages(total_pages), page1_rows=rows)
+        plan['resumed'] = journal.start(total_pages) if journal is not None else {}
+        return [page_num for page_num in plan['selected'] if page_num != 1 and page_num not in plan['resumed']]
+
+    speculative_pages = []
+    if predicted_pages:
+        journal_pages = {}
+        if journal is not None and journal.pages:
+            # The journal's page count is more recent than the previous snapshot's
+            predicted_pages, journal_pages = journal.total_pages, journal.pages
+        speculative_pages = [page_num for page_num in select_pages(predicted_pages) if page_num != 1 and page_num not in journal_pages]
+
+    finished_pages = set()
+    seen_ids = set()
+    pending_parses = {}
+
+    def finish_page(page_num, rows):
+        finished_pages.add(page_num)
+        if fallback_rows is not None:
+            seen_ids.update(entry.get('domain_id') for entry in rows)
+        return page_num, rows
+
+    for page_num, html_content in fetch_pages(plan_pages, speculative_pages, page_cache, metrics):
+        if page_num == 1:
+            # Already parsed by plan_pages
+            if 1 in plan['selected']:
+                yield finish_page(1, plan['page1_rows'])
+            for resumed_page_num, rows in sorted(plan['resumed'].items()):
+                if resumed_page_num in plan['selected']:
+                    if metrics is not None:
+                        metrics.record_carried_rows(resumed_page_num, len(rows), resumed=True)
+                    yield finish_page(resumed_page_num, rows)
+            continue
+        try:
+            result = submit_parse(parse_executor, page_num, html_content, page_cache, journal)
+        except Exception as exc:
+            print(f'Page {page_num} generated an unexpected exception: {exc}')
+            continue
+        if result is None:
+            continue
+        if isinstance(result, Future):
+            pending_parses[result] = page_num
+        else:
+            yield finish_page(page_num, resolve_parse(page_num, result, page_cache, metrics))
+        for future in [future for future in pending_parses if future.done()]:
+            parsed_page_num = pending_parses.pop(future)
+            rows = resolve_parse(parsed_page_num, future, page_cache, metrics)
+            if rows is not None:
+                yield finish_page(parsed_page_num, rows)
+    for future in as_completed(list(pending_parses)):
+        parsed_page_num = pending_parses.pop(future)
+        rows = resolve_parse(parsed_page_num, future, page_cache, metrics)
+        if rows is not None:
+            yield finish_page(parsed_page_num, rows)
+
+    if page_cache is not None:
+        page_cache.save(range(1, plan['total_pages'] + 1))
+    missing_pages = plan['missing_pages'] = [page_num for page_num in plan['selected'] if page_num not in finished_pages]
+    if journal is not None:
+        journal.missing_pages = missing_pages
+    if missing_pages and fallback_rows is not None:
+        yield from carry_over_rows(fallback_rows, missing_pages, seen_ids, metrics, "could not be fetched").items()
+
+def carry_over_rows(fallback_rows, missing_pages, seen_ids, metrics=None, reason="could not be fetched"):
+    """fallback_rows(missing_pages)'s rows, minus domains in seen_ids, keyed by page number in page order."""
+    carried = {}
+    for page_num, rows in sorted(fallback_rows(missing_pages).items()):
+        carried[page_num] = [entry for entry in rows if entry.get('domain_id') is None or entry['domain_id'] not in seen_ids]
+        if metrics is not None:
+            metrics.record_carried_rows(page_num, len(carried[page_num]))
+    print(f"Carried over {sum(len(rows) for rows in carried.values())} rows from the previous snapshot "
+          f"for {len(missing_pages)} pages that {reason}: {missing_pages}")
+    return carried
+
+def enrich_entry(entry, previous_first_seen, today_str):
+    first_seen = previous_first_seen.get(entry.get('domain_id'), today_str)
+    entry['first_seen'] = first_seen
+    entry['fraidex_age_days'] = get_fraidex_age_days(first_seen)
+    return entry
+
+def iter_domains(first_page=1, last_page=None, previous_first_seen=None, page_cache=None, metrics=None, journal=None,
+                 predicted_pages=None):
+    """Streaming API: yields each domain record as soon as its page is parsed, in page completion order.
+
+    Records are the parsed rows; with a previous_first_seen map (see load_previous_first_seen) they
+    also get first_seen/fraidex_age_days. predicted_pages starts fetching pages before page 1 is in,
+    see iter_crawl_pages. Settings come from the module constants, see configure().
+    Raises CrawlError if page 1 cannot be fetched.
+    """
+    today_str = datetime.utcnow().strftime('%Y-%m-%d')
+    parse_executor = create_parse_executor()
+    try:
+        for _, rows in iter_crawl_pages(first_page, last_page, parse_executor, page_cache, metrics, journal,
+                                        predicted_pages=predicted_pages):
+            for entry in rows:
+                if previous_first_seen is not None:
+                    # Copied so page cache entries keep the rows exactly as parsed
+                    entry = enrich_entry(dict(entry), previous_first_seen, today_str)
+                yield entry
+    finally:
+        if parse_executor is not None:
+            parse_executor.shutdown(cancel_futures=True)
+
+def configure(max_workers=None, request_timeout=None, crawl_mode=None, parse_workers=None, parse_engine=None,
+              crawl_deadline_seconds=None):
+    """Overrides the FRAIDEX_* settings for this process; None keeps the current value."""
+    global MAX_WORKERS, ASYNC_MAX_CONCURRENCY, ASYNC_INITIAL_CONCURRENCY, REQUEST_TIMEOUT, CRAWL_MODE
+    global PARSE_WORKERS, PARSE_ENGINE, CRAWL_DEADLINE_SECONDS
+    if max_workers is not None:
+        # Also the async mode's concurrency ceiling
+        MAX_WORKERS = ASYNC_MAX_CONCURRENCY = max_workers
+        ASYNC_INITIAL_CONCURRENCY = min(ASYNC_INITIAL_CONCURRENCY, max_workers)
+    if request_timeout is not None:
+        REQUEST_TIMEOUT = request_timeout
+    if crawl_mode is not None:
+        CRAWL_MODE = crawl_mode
+    if parse_workers is not None:
+        PARSE_WORKERS = parse_workers
+    if parse_engine is not None:
+        PARSE_ENGINE = parse_engine
+    if crawl_deadline_seconds is not None:
+        CRAWL_DEADLINE_SECONDS = crawl_deadline_seconds
+
+def get_tld(domain_name):
+    """Everything after the first dot, as the frontend derives it (the whole name if there is none)."""
+    dot_index = domain_name.find('.')
+    if dot_index != -1 and dot_index < len(domain_name) - 1:
+        return domain_name[dot_index + 1:]
+    return domain_name
+
+def build_columnar_data(all_domains_data):
+    """Builds the columnar output: one array per field, with status, owner and TLD as integer
+    codes into lookup tables and the frontend's derived tld/length/domain_level precomputed.
+    age_raw_text is left out; date_added and age_days already carry its information."""
+    tables = {'status': [], 'owner_name': [], 'owner_id': [], 'tld': []}
+    status_codes, owner_codes, tld_codes = {}, {}, {}
+    plain_fields = ['domain_id', 'domain_name', 'hosts_in_use', 'website', 'date_added', 'age_days',
+                    'source_page_number', 'first_seen', 'fraidex_age_days']
+    columns = {field: [] for field in plain_fields}
+    columns.update({'status': [], 'owner': [], 'tld': [], 'length': [], 'domain_level': []})
 
-        print("Processing page 1...")
-        all_domains_data.extend(process_html_content(1, html_content_page1))
-
-        pages_to_fetch_nums = list(range(2, total_pages + 1))
-        
-        if pages_to_fetch_nums:
-            print(f"Concurrently fetching and processing pages 2 to {total_pages} with {MAX_WORKERS} workers...")
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                future_to_page_num = {
-                    executor.submit(fetch_page_content, page_num, session): page_num 
-                    for page_num in pages_to_fetch_nums
-                }
-                
-                completed_count = 0
-                total_tasks = len(pages_to_fetch_nums)
-                for future in as_completed(future_to_page_num):
-                    original_page_num = future_to_page_num[future]
-                    try:
-                        fetched_page_num, html_content = future.result() 
-                        if html_content:
-                            all_domains_data.extend(process_html_content(fetched_page_num, html_content))
-                    except Exception as exc:
-                        print(f'Page {original_page_num} generated an unexpected exception: {exc}')
-                    
-                    completed_count += 1
-                    if completed_count % 20 == 0 or completed_count == total_tasks :
-                         print(f"Fetched and processed {completed_count}/{total_tasks} pages...")
-    # Enrich each entry with first_seen / fraidex_age_days
+    for entry in all_domains_data:
+        for field in plain_fields:
+            columns[field].append(entry.get(field))
+
+        status = entry.get('status')
+        if status not in status_codes:
+            status_codes[status] = len(tables['status'])
+            tables['status'].append(status)
+        columns['status'].append(status_codes[status])
+
+        owner_key = (entry.get('owner_name'), entry.get('owner_id'))
+        if owner_key not in owner_codes:
+            owner_codes[owner_key] = len(tables['owner_name'])
+            tables['owner_name'].append(owner_key[0])
+            tables['owner_id'].append(owner_key[1])
+        columns['owner'].append(owner_codes[owner_key])
+
+        domain_name = entry.get('domain_name') or ''
+        tld = get_tld(domain_name)
+        if tld not in tld_codes:
+            tld_codes[tld] = len(tables['tld'])
+            tables['tld'].append(tld)
+        columns['tld'].append(tld_codes[tld])
+        columns['length'].append(len(domain_name))
+        columns['domain_level'].append(len(tld.split('.')) if tld else 0)
+
+    return {'version': COLUMNAR_FORMAT_VERSION, 'count': len(all_domains_data), 'tables': tables, 'columns': columns}
+
+def write_columnar_output(all_domains_data, path=None):
+    """Writes the columnar file plus precompressed .gz (and .br when brotli is installed) variants."""
+    path = path or COLUMNAR_JSON_FILE
+    payload = json.dumps(build_columnar_data(all_domains_data), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    variants = [(path, payload), (path + '.gz', gzip.compress(payload, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append((path + '.br', brotli.compress(payload, quality=11)))
+    else:
+        print("Skipping the .br columnar variant; install 'brotli' to produce it: pip install brotli")
+    try:
+        for variant_path, data in variants:
+            with open(variant_path, 'wb') as f:
+                f.write(data)
+        print(f"Wrote columnar output to {path} ({', '.join(f'{len(data)} bytes' for _, data in variants)}).")
+    except IOError as e:
+        print(f"Error writing columnar output {path}: {e}")
+
+def build_trigram_postings(all_domains_data):
+    """Maps each trigram of the lowercased domain_name to the ascending row positions containing it."""
+    postings = {}
+    for position, entry in enumerate(all_domains_data):
+        name = (entry.get('domain_name') or '').lower()
+        for trigram in {name[i:i + 3] for i in range(len(name) - 2)}:
+            postings.setdefault(trigram, []).append(position)
+    return postings
+
+def _write_compact_json(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+
+def write_search_index(all_domains_data, index_dir=None):
+    """Writes the search artifacts for the domain browser into index_dir.
+
+    Layout (all positions are row positions in fraidex.json / fraidex.columns.json):
+      manifest.json        - shard and bucket file names, row counts
+      tld/<code>.json      - columnar rows of one TLD, with their positions
+      status/<code>.json   - columnar rows of one status, with their positions
+      trigrams/<hex>.json  - {trigram: delta-encoded positions}, bucketed by the trigram's first character
+    A substring query of 3+ characters intersects the posting lists of its trigrams and then
+    confirms each candidate with a plain includes() check.
+    """
+    index_dir = index_dir or SEARCH_INDEX_DIR
+    try:
+        if os.path.isdir(index_dir):
+            shutil.rmtree(index_dir) # Every file in here is regenerated; stale shards must not linger
+        for subdir in ('tld', 'status', 'trigrams'):
+            os.makedirs(os.path.join(index_dir, subdir))
+
+        manifest = {'version': SEARCH_INDEX_VERSION, 'count': len(all_domains_data), 'tld': {}, 'status': {}, 'trigrams': {}}
+        for shard_kind, key_of in (('tld', lambda entry: get_tld(entry.get('domain_name') or '')),
+                                   ('status', lambda entry: entry.get('status'))):
+            positions_by_key = {}
+            for position, entry in enumerate(all_domains_data):
+                positions_by_key.setdefault(key_of(entry), []).append(position)
+            for code, (key, positions) in enumerate(sorted(positions_by_key.items(), key=lambda item: str(item[0]))):
+                shard_file = f"{shard_kind}/{code}.json"
+                shard = build_columnar_data([all_domains_data[position] for position in positions])
+                shard['positions'] = positions
+                _write_compact_json(os.path.join(index_dir, shard_file), shard)
+                manifest[shard_kind][key] = {'file': shard_file, 'count': len(positions)}
+
+        buckets = {}
+        for trigram, positions in build_trigram_postings(all_domains_data).items():
+            deltas = [positions[0]] + [positions[i] - positions[i - 1] for i in range(1, len(positions))]
+            buckets.setdefault(format(ord(trigram[0]), 'x'), {})[trigram] = deltas
+        for bucket, postings in sorted(buckets.items()):
+            bucket_file = f"trigrams/{bucket}.json"
+            _write_compact_json(os.path.join(index_dir, bucket_file), postings)
+            manifest['trigrams'][bucket] = {'file': bucket_file, 'count': len(postings)}
+
+        _write_compact_json(os.path.join(index_dir, 'manifest.json'), manifest)
+        print(f"Wrote search index to {index_dir} ({len(manifest['tld'])} TLD shards, "
+              f"{len(manifest['status'])} status shards, {len(buckets)} trigram buckets).")
+    except (IOError, OSError) as e:
+        print(f"Error writing search index {index_dir}: {e}")
+
+def write_patch_output(diff, base_count, count, path=None):
+    """Writes the diff against the previous run (base_count is None without one).
+
+    base_sha256 lets a consumer check that its copy is the patch's base before applying it.
+    target_sha256 is the hash of the published fraidex.json the patch leads to. It identifies that
+    snapshot (the next patch's base_sha256 equals it) and is not a check for the patched copy, which
+    never hashes the same: the patch leaves out PATCH_IGNORED_FIELDS and row order.
+    """
+    path = path or PATCH_JSON_FILE
+    patch = {
+        'version': PATCH_FORMAT_VERSION,
+        'generated_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'base_sha256': file_sha256(PREVIOUS_JSON_FILE) if base_count is not None else None,
+        'target_sha256': file_sha256(OUTPUT_JSON_FILE), # Identifies the published file, not a post-apply check
+        'base_count': base_count or 0,
+        'count': count,
+        'ignored_fields': list(PATCH_IGNORED_FIELDS),
+        **diff,
+    }
+    try:
+        _write_compact_json(path, patch)
+        print(f"Wrote patch to {path}: {len(patch['added'])} added, {len(patch['removed'])} removed, "
+              f"{len(patch['changed'])} changed.")
+    except IOError as e:
+        print(f"Error writing patch file {path}: {e}")
+
+def open_previous_run():
+    """Returns (history store or None, previous snapshot rows or None).
+
+    With FRAIDEX_HISTORY_DB the store carries the previous run (bootstrapped once from the previous
+    snapshot) and the snapshot is not kept in memory; otherwise the previous snapshot is loaded.
+    """
+    history = HistoryStore.open(HISTORY_DB_FILE) if HISTORY_DB_FILE else None
+    if history is None:
+        return None, load_previous_data()
+    if history.is_empty():
+        # One-time bootstrap; afterwards the previous snapshot is never loaded into memory
+        bootstrap_data = load_previous_data()
+        if bootstrap_data:
+            history.import_snapshot(bootstrap_data, file_sha256(PREVIOUS_JSON_FILE))
+        del bootstrap_data
+    return history, None
+
+def previous_fallback_rows(history, prev_data):
+    """fallback_rows for iter_crawl_pages: the previous run's rows for pages that could not be fetched."""
+    if history is not None:
+        return history.previous_rows_by_page
+    return lambda page_nums: previous_rows_by_page(prev_data, page_nums)
+
+def drop_duplicate_domains(all_domains_data):
+    """Keeps the first row of each domain_id, so every output indexes the same rows."""
+    unique_rows = []
+    seen_ids = set()
+    duplicate_count = 0
     for entry in all_domains_data:
         did = entry.get('domain_id')
-        first_seen = previous_first_seen.get(did, today_str)
-        entry['first_seen'] = first_seen
-        try:
-            fs_date = datetime.strptime(first_seen, '%Y-%m-%d')
-            entry['fraidex_age_days'] = (datetime.utcnow() - fs_date).days
-        except ValueError:
-            entry['fraidex_age_days'] = 0
+        if did is not None:
+            if did in seen_ids:
+                duplicate_count += 1
+                continue
+            seen_ids.add(did)
+        unique_rows.append(entry)
+    if duplicate_count:
+        print(f"Dropped {duplicate_count} duplicate domain rows (domains that moved between pages during the crawl).")
+    return unique_rows
+
+def publish_snapshot(all_domains_data, history, prev_data, today_str):
+    """Applies first_seen/fraidex_age_days and writes fraidex.json plus the columnar, index and patch outputs.
+
+    Rows are de-duplicated by domain_id first. Closes the history store.
+    """
+    all_domains_data = drop_duplicate_domains(all_domains_data)
+    if history is None:
+        # Enrich each entry with first_seen / fraidex_age_days
+        previous_first_seen = load_previous_first_seen(prev_data or [])
+        for entry in all_domains_data:
+            enrich_entry(entry, previous_first_seen, today_str)
+        diff = build_patch(prev_data, all_domains_data)
+        base_count = len(prev_data) if prev_data is not None else None
+        del previous_first_seen
+    else:
+        # Upserting enriches the entries in place; the snapshot is then streamed from the store
+        diff, base_count = history.record_run(all_domains_data, today_str, base_sha256=file_sha256(PREVIOUS_JSON_FILE))
+        if diff is None:
+            print(f"The history store's latest run did not publish {PREVIOUS_JSON_FILE}; diffing against that file instead.")
+            base_data = load_previous_data()
+            diff = build_patch(base_data, all_domains_data)
+            base_count = len(base_data) if base_data is not None else None
+            del base_data
 
     try:
-        with open(OUTPUT_JSON_FILE, 'w', encoding='utf-8') as f:
-            json.dump(all_domains_data, f, indent=2, ensure_ascii=False)
+        if history is None:
+            with open(OUTPUT_JSON_FILE, 'w', encoding='utf-8') as f:
+                json.dump(all_domains_data, f, indent=2, ensure_ascii=False)
+        else:
+            history.write_snapshot(OUTPUT_JSON_FILE, all_domains_data)
+            history.record_snapshot_hash(file_sha256(OUTPUT_JSON_FILE))
         print(f"Successfully scraped {len(all_domains_data)} domains into {OUTPUT_JSON_FILE}")
-    except IOError as e:
+    except (IOError, sqlite3.Error) as e:
         print(f"Error writing to JSON file {OUTPUT_JSON_FILE}: {e}")
+    finally:
+        if history is not None:
+            history.close()
+    write_columnar_output(all_domains_data)
+    write_search_index(all_domains_data)
+    write_patch_output(diff, base_count, len(all_domains_data))
+
+def main():
+    """Runs the full update. Returns the process exit status: 0 once every page was crawled, 1 if the
+    crawl could not start (nothing is written), 2 if pages are missing (the journal is kept, so a rerun
+    only fetches those). With missing pages, outputs are written with rows carried over for them,
+    unless PUBLISH_INCOMPLETE is off and the journal is active."""
+    start_time = time.time()
+    today_str = datetime.utcnow().strftime('%Y-%m-%d')
+    history, prev_data = open_previous_run()
+    fallback_rows = previous_fallback_rows(history, prev_data)
+    predicted_pages = None
+    if SPECULATIVE_FETCH:
+        predicted_pages = history.previous_page_count() if history is not None else previous_page_count(prev_data)
+
+    page_cache = PageCache.load(PAGE_CACHE_FILE) if PAGE_CACHE_FILE else None
+    journal = CrawlJournal.load(JOURNAL_FILE) if JOURNAL_FILE else None
+    metrics = CrawlMetrics()
+    parse_executor = create_parse_executor()
+    if parse_executor is not None:
+        print(f"Parsing pages in a pool of {PARSE_WORKERS} processes.")
+    crawl_plan = {}
+    try:
+        rows_by_page = dict(iter_crawl_pages(parse_executor=parse_executor, page_cache=page_cache, metrics=metrics,
+                                             journal=journal, fallback_rows=fallback_rows, predicted_pages=predicted_pages,
+                                             crawl_plan=crawl_plan))
+    except CrawlError as e:
+        print(f"{e} Exiting.")
+        rows_by_page = None
+    finally:
+        if parse_executor is not None:
+            parse_executor.shutdown(cancel_futures=True)
+        metrics.write()
+    if rows_by_page is None:
+        if history is not None:
+            history.close()
+        return 1
+    if crawl_plan['missing_pages'] and not PUBLISH_INCOMPLETE and journal is not None and journal.file is not None:
+        journal.finish()
+        if history is not None:
+            history.close()
+        print(f"Not publishing: {len(crawl_plan['missing_pages'])} pages are missing. Rerun to resume from the journal.")
+        return 2
+    all_domains_data = [entry for page_num in sorted(rows_by_page) for entry in rows_by_page[page_num]]
+    del rows_by_page
+
+    publish_snapshot(all_domains_data, history, prev_data, today_str)
+    if journal is not None:
+        # Only now that every output is written is it safe to drop the checkpoint
+        journal.finish()
 
     end_time = time.time()
     print(f"Scraping completed in {end_time - start_time:.2f} seconds.")
+    return 2 if crawl_plan['missing_pages'] else 0
+
+def shard_path(path, shard_index, shard_count):
+    """Per-shard variant of a state file path, so shards on one machine never share a cache or journal."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard-{shard_index}-of-{shard_count}{ext}"
+
+def run_shard(shard_index, shard_count, output_path=None, run_id=None):
+    """Crawls one contiguous slice of the page range into a partial result file for merge_shards.
+
+    The file is NDJSON: a header line, the raw parsed rows as they come in, and a footer with the
+    page count and the pages the shard finished. It is written under a temporary name and renamed
+    once complete. run_id defaults to FRAIDEX_RUN_ID. Returns False if the crawl could not start.
+    """
+    start_time = time.time()
+    output_path = output_path or SHARD_FILE_TEMPLATE.format(index=shard_index, count=shard_count)
+    page_cache = PageCache.load(shard_path(PAGE_CACHE_FILE, shard_index, shard_count)) if PAGE_CACHE_FILE else None
+    journal = CrawlJournal.load(shard_path(JOURNAL_FILE, shard_index, shard_count)) if JOURNAL_FILE else None
+    predicted_pages = previous_page_count(load_previous_data()) if SPECULATIVE_FETCH else None
+    metrics = CrawlMetrics()
+    crawl_plan = {}
+    finished_pages = []
+    row_count = 0
+    parse_executor = create_parse_executor()
+    try:
+        with open(output_path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'version': SHARD_FORMAT_VERSION, 'shard_index': shard_index, 'shard_count': shard_count,
+                                'run_id': run_id or SHARD_RUN_ID or None,
+                                'started_at': datetime.utcnow().strftime(SHARD_TIME_FORMAT)}) + '\n')
+            for page_num, rows in iter_crawl_pages(parse_executor=parse_executor, page_cache=page_cache, metrics=metrics,
+                                                   journal=journal, predicted_pages=predicted_pages,
+                                                   shard=(shard_index, shard_count), crawl_plan=crawl_plan):
+                for entry in rows:
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                finished_pages.append(page_num)
+                row_count += len(rows)
+            f.write(json.dumps({'total_pages': crawl_plan['total_pages'], 'pages': sorted(finished_pages)}) + '\n')
+        os.replace(output_path + '.tmp', output_path)
+    except CrawlError as e:
+        print(f"{e} Exiting.")
+        os.remove(output_path + '.tmp')
+        return False
+    finally:
+        if parse_executor is not None:
+            parse_executor.shutdown(cancel_futures=True)
+        metrics.write(shard_path(METRICS_JSON_FILE, shard_index, shard_count) if METRICS_JSON_FILE else '',
+                      shard_path(METRICS_PROMETHEUS_FILE, shard_index, shard_count) if METRICS_PROMETHEUS_FILE else '')
+    if journal is not None:
+        journal.finish()
+    print(f"Shard {shard_index + 1}/{shard_count}: wrote {row_count} domains from {len(finished_pages)} pages "
+          f"to {output_path} in {time.time() - start_time:.2f} seconds.")
+    return True
+
+def load_shard(path):
+    """Reads a shard file into (header, rows, footer); footer is None if the file is incomplete."""
+    with open(path, 'r', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records or records[0].get('version') != SHARD_FORMAT_VERSION:
+        raise ValueError(f"{path} is not a version {SHARD_FORMAT_VERSION} shard file")
+    footer = records[-1] if len(records) > 1 and 'total_pages' in records[-1] else None
+    return records[0], records[1:-1] if footer is not None else records[1:], footer
+
+def merge_shard_rows(shards, fallback_rows):
+    """Combines loaded shards into one list of rows in page order.
+
+    Pages that no complete shard finished (failed pages, or a missing shard's whole slice) get the
+    previous run's rows from fallback_rows, minus domains the shards already have.
+    """
+    total_pages = max(footer['total_pages'] for _, _, footer in shards)
+    if len({footer['total_pages'] for _, _, footer in shards}) > 1:
+        print(f"Warning: shards saw different page counts; merging up to page {total_pages}.")
+    rows_by_page = {}
+    for header, rows, footer in shards:
+        shard_rows_by_page = {page_num: [] for page_num in footer['pages']}
+        for entry in rows:
+            shard_rows_by_page.setdefault(entry['source_page_number'], []).append(entry)
+        for page_num, page_rows in shard_rows_by_page.items():
+            # Overlapping slices (different page counts) keep the lower shard's copy
+            rows_by_page.setdefault(page_num, page_rows)
+
+    missing_pages = [page_num for page_num in range(1, total_pages + 1) if page_num not in rows_by_page]
+    if missing_pages:
+        seen_ids = {entry.get('domain_id') for page_rows in rows_by_page.values() for entry in page_rows}
+        rows_by_page.update(carry_over_rows(fallback_rows, missing_pages, seen_ids, reason="no shard fetched"))
+    return [entry for page_num in sorted(rows_by_page) for entry in rows_by_page[page_num]]
+
+def current_run_shards(shards):
+    """Drops shards left over from earlier runs: those whose run id differs from the newest shard's,
+    or, without run ids, those that started SHARD_MAX_START_SKEW_SECONDS or more before it."""
+    def started_at(shard):
+        return datetime.strptime(shard[0]['started_at'], SHARD_TIME_FORMAT)
+
+    newest = max(shards, key=started_at)
+    current = []
+    for shard in shards:
+        header = shard[0]
+        if newest[0].get('run_id') is not None:
+            stale = header.get('run_id') != newest[0]['run_id']
+        else:
+            stale = (started_at(newest) - started_at(shard)).total_seconds() >= SHARD_MAX_START_SKEW_SECONDS
+        if stale:
+            print(f"Skipping stale shard {header['shard_index']} of {header['shard_count']} "
+                  f"(run {header.get('run_id')}, started {header['started_at']}).")
+            continue
+        current.append(shard)
+    return current
+
+def merge_shards(shard_paths):
+    """Merges shard files into fraidex.json and its derived outputs, applying first_seen once.
+
+    Only the newest run's shards are merged (see current_run_shards); their files are renamed to
+    *.merged afterwards so a later merge cannot pick them up again. Returns False (writing nothing)
+    if no complete shard was found.
+    """
+    start_time = time.time()
+    today_str = datetime.utcnow().strftime('%Y-%m-%d')
+    shards = []
+    for path in shard_paths:
+        try:
+            header, rows, footer = load_shard(path)
+        except (IOError, ValueError) as e:
+            print(f"Skipping shard file {path}: {e}")
+            continue
+        if footer is None:
+            print(f"Skipping incomplete shard file {path}.")
+            continue
+        shards.append((header, rows, footer, path))
+    if not shards:
+        print("No complete shard files to merge.")
+        return False
+    shards = current_run_shards(shards)
+    shard_counts = sorted({shard[0]['shard_count'] for shard in shards})
+    if len(shard_counts) > 1:
+        print(f"Shard files come from crawls split {shard_counts} ways; merge one crawl's shards at a time.")
+        return False
+    shards.sort(key=lambda shard: shard[0]['shard_index'])
+    present = {shard[0]['shard_index'] for shard in shards}
+    absent = [shard_index for shard_index in range(shard_counts[0]) if shard_index not in present]
+    if absent:
+        print(f"Warning: shards {absent} of {shard_counts[0]} are missing; their pages come from the previous snapshot.")
+    print(f"Merging {len(shards)} shard files with {sum(len(shard[1]) for shard in shards)} rows.")
+
+    history, prev_data = open_previous_run()
+    all_domains_data = merge_shard_rows([shard[:3] for shard in shards], previous_fallback_rows(history, prev_data))
+    merged_paths = [shard[3] for shard in shards]
+    del shards
+    publish_snapshot(all_domains_data, history, prev_data, today_str)
+    for path in merged_paths:
+        os.replace(path, path + '.merged')
+    print(f"Merge completed in {time.time() - start_time:.2f} seconds.")
+    return True
+
+def parse_page_range(text):
+    """'5' -> (5, 5), '5-20' -> (5, 20), '5-' -> (5, None), '-20' -> (1, 20)."""
+    first_text, dash, last_text = text.partition('-')
+    try:
+        first_page = int(first_text) if first_text else 1
+        last_page = (int(last_text) if last_text else None) if dash else first_page
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid page range {text!r}")
+    if first_page < 1 or (last_page is not None and last_page < first_page):
+        raise argparse.ArgumentTypeError(f"invalid page range {text!r}")
+    return first_page, last_page
+
+def write_records(records, output, output_format):
+    """Writes records to a text stream as NDJSON (one per line) or as one streamed JSON array; returns the count."""
+    count = 0
+    if output_format == 'json':
+        output.write('[')
+    for entry in records:
+        if output_format == 'json':
+            output.write(',\n' if count else '\n')
+        output.write(json.dumps(entry, ensure_ascii=False))
+        if output_format == 'ndjson':
+            output.write('\n')
+        count += 1
+        if count % STREAM_FLUSH_ROWS == 0:
+            output.flush()
+    if output_format == 'json':
+        output.write('\n]\n' if count else ']\n')
+    output.flush()
+    return count
+
+def add_crawl_arguments(command_parser):
+    command_parser.add_argument('--workers', type=int, help="Fetch threads / async concurrency ceiling (FRAIDEX_MAX_WORKERS)")
+    command_parser.add_argument('--mode', choices=('threads', 'async'), help="Crawl mode (FRAIDEX_CRAWL_MODE)")
+    command_parser.add_argument('--parse-workers', type=int, help="Parse processes, 0 parses inline (FRAIDEX_PARSE_WORKERS)")
+    command_parser.add_argument('--engine', choices=('bs4', 'lxml', 'parity'), help="Parse engine (FRAIDEX_PARSE_ENGINE)")
+    command_parser.add_argument('--timeout', type=float, help=f"Per-request timeout in seconds (default {REQUEST_TIMEOUT})")
+    command_parser.add_argument('--deadline', type=float, help="Give up on unfetched pages after this many seconds (FRAIDEX_CRAWL_DEADLINE_SECONDS)")
+
+def configure_from_args(args):
+    configure(max_workers=args.workers, request_timeout=args.timeout, crawl_mode=args.mode,
+              parse_workers=args.parse_workers, parse_engine=args.engine, crawl_deadline_seconds=args.deadline)
+
+def run_stream(args):
+    """The 'stream' command: crawls and writes records as they are parsed, with no other outputs."""
+    configure_from_args(args)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    destination = 'stdout' if args.output == '-' else args.output
+    # Progress messages go to stderr so stdout carries nothing but records
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            previous_first_seen = load_previous_first_seen() if args.first_seen else None
+            first_page, last_page = args.pages
+            with contextlib.closing(iter_domains(first_page, last_page, previous_first_seen)) as records:
+                count = write_records(records, output, args.format)
+            print(f"Streamed {count} domains to {destination}.")
+        except CrawlError as e:
+            print(e)
+            return 1
+        except BrokenPipeError:
+            print("The reader closed the output; stopping the crawl.")
+            if args.output == '-':
+                # Keeps the interpreter's final flush of stdout from raising again
+                os.dup2(os.open(os.devnull, os.O_WRONLY), output.fileno())
+            return 1
+        finally:
+            if args.output != '-':
+                output.close()
+    return 0
+
+def cli(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        description="Scrapes the FreeDNS domain registry. Without a command, runs the full update "
+                    "(fraidex.json plus the columnar, index and patch outputs).")
+    commands = arg_parser.add_subparsers(dest='command')
+    stream_parser = commands.add_parser('stream', help="Stream domain records as each page is parsed")
+    stream_parser.add_argument('-o', '--output', default='-', help="Output file ('-' for stdout, the default)")
+    stream_parser.add_argument('-f', '--format', choices=('ndjson', 'json'), default='ndjson')
+    stream_parser.add_argument('--pages', type=parse_page_range, default=(1, None), help="Page range, e.g. 1-50, 200- or 7")
+    add_crawl_arguments(stream_parser)
+    stream_parser.add_argument('--first-seen', action='store_true', help=f"Add first_seen/fraidex_age_days from {os.path.basename(PREVIOUS_JSON_FILE)}")
+    shard_parser = commands.add_parser('shard', help="Crawl one slice of the page range into a partial result file")
+    shard_parser.add_argument('--index', type=int, required=True, help="This shard's index, 0-based")
+    shard_parser.add_argument('--count', type=int, required=True, help="Number of shards the page range is split into")
+    shard_parser.add_argument('-o', '--output', help=f"Partial result file (default {os.path.basename(SHARD_FILE_TEMPLATE)})")
+    shard_parser.add_argument('--run-id', help="Id shared by all shards of one crawl, checked by merge (FRAIDEX_RUN_ID)")
+    add_crawl_arguments(shard_parser)
+    merge_parser = commands.add_parser('merge', help="Merge shard files into fraidex.json and the derived outputs")
+    merge_parser.add_argument('shards', nargs='*', help="Shard files (default: every fraidex.shard-*.ndjson next to this script)")
+    args = arg_parser.parse_args(argv)
+    if args.command == 'stream':
+        return run_stream(args)
+    if args.command == 'shard':
+        if not 0 <= args.index < args.count:
+            arg_parser.error("--index must be between 0 and --count - 1")
+        configure_from_args(args)
+        return 0 if run_shard(args.index, args.count, args.output, args.run_id) else 1
+    if args.command == 'merge':
+        shard_paths = args.shards or sorted(glob.glob(SHARD_FILE_TEMPLATE.format(index='*', count='*')))
+        return 0 if merge_shards(shard_paths) else 1
+    return main()
 
 if __name__ == "__main__":
     try:
         import lxml
     except ImportError:
-        print("Consider installing 'lxml' for faster HTML parsing: pip install lxml")
-    main()
\ No newline at end of file
+        print("Consider installing 'lxml' for faster HTML parsing: pip install lxml", file=sys.stderr)
+    sys.exit(cli())
\ No newline at end of file